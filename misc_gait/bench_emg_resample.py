@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark EMG downsampling methods on real trials.
+
+Compares the runtime of the downsampling methods in emgproc.downsample()
+and their output against the FFT method (scipy.signal.resample). Errors are
+reported separately for the interior of the trial and for the edges, where
+the FFT method rings.
+
+@author: Jussi (jnu@iki.fi)
+
+"""
+
+# %% init
+
+import time
+import logging
+import numpy as np
+from collections import defaultdict
+
+from gaitutils.envutils import GaitDataError
+
+import emgproc
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+session_root = r'C:\Users\hus20664877\Downloads\C3D files'
+
+# frames at each end that are counted as edge
+EDGE_FRAMES = 10
+METHODS = ['fft', 'poly', 'decimate']
+
+
+def _rel_rms(x, ref):
+    """RMS of the difference relative to RMS of the reference"""
+    return np.sqrt(np.mean((x - ref) ** 2)) / np.sqrt(np.mean(ref**2))
+
+
+# %% run the benchmark
+
+times = defaultdict(float)
+errs_interior = defaultdict(list)
+errs_edge = defaultdict(list)
+n_files = 0
+
+for c3dfile in emgproc.find_c3ds(session_root):
+    try:
+        chnames, data, emgrate, framerate, nframes = emgproc._read_emg_c3d(c3dfile)
+    except GaitDataError:
+        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
+        continue
+    n_files += 1
+    auto_method = emgproc._resample_method(emgrate, framerate)[0]
+    # full-rate signals to downsample
+    emg_rectified = np.abs(
+        emgproc._filtfilt(data, emgproc.BUTTER_ORDER, emgproc.HPF, emgrate, 'high')
+    )
+    emg_lenv = emgproc._filtfilt(
+        emg_rectified, emgproc.BUTTER_ORDER, emgproc.LPF, emgrate, 'low'
+    )
+    for kind, sig in [('rectified', emg_rectified), ('linear_envelope', emg_lenv)]:
+        outputs = dict()
+        for method in METHODS:
+            if method == 'decimate' and auto_method != 'decimate':
+                continue  # not an integer ratio
+            t0 = time.perf_counter()
+            outputs[method] = emgproc.downsample(
+                sig, nframes, emgrate, framerate, method=method
+            )
+            times[method] += time.perf_counter() - t0
+        ref = outputs['fft']
+        inner = slice(EDGE_FRAMES, -EDGE_FRAMES)
+        for method, out in outputs.items():
+            if method == 'fft':
+                continue
+            errs_interior[(kind, method)].append(_rel_rms(out[:, inner], ref[:, inner]))
+            edges = np.r_[0:EDGE_FRAMES, nframes - EDGE_FRAMES : nframes]
+            errs_edge[(kind, method)].append(_rel_rms(out[:, edges], ref[:, edges]))
+
+print('%d files' % n_files)
+print('%-10s %12s' % ('method', 'total time'))
+for method, t in times.items():
+    print('%-10s %10.2f s' % (method, t))
+print()
+print('%-16s %-10s %16s %16s' % ('signal', 'method', 'interior error', 'edge error'))
+for (kind, method), errs in errs_interior.items():
+    print(
+        '%-16s %-10s %15.3f%% %15.3f%%'
+        % (
+            kind,
+            method,
+            100 * np.mean(errs),
+            100 * np.mean(errs_edge[(kind, method)]),
+        )
+    )
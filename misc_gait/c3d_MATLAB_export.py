@@ -19,6 +19,7 @@ from gaitutils.stats import collect_trial_data
 from gaitutils.envutils import GaitDataError
 from gaitutils.config import cfg
 
+import stageprof
 
 DATA_FLDR = 'Z:/Misc/0_Mika/CP-projekti/HP/H0188_AJ/2022_06_20_seur_AJ/'
 MODEL_VAR_NAMES = {'RAnkleAnglesX', 'LAnkleAnglesX',
@@ -72,12 +73,17 @@ VALID_ECLIPSE_TAGS = {'E2', 'E3', 'E4', 'T2', 'T3', 'T4'}
 # VALID_ECLIPSE_TAGS = {'T1', 'E1'}
 MODEL_OUT_FNAME = 'C:/Users/vicon123/model_exported.mat'
 EMG_OUT_FNAME = 'C:/Users/vicon123/emg_exported.mat'
+# record time and memory use per processing stage
+PROFILE = False
+PROFILE_OUT_FNAME = 'C:/Users/vicon123/export_profile.json'
 
 
 logger = logging.getLogger(__name__)
 
 
 def main():
+    if PROFILE:
+        stageprof.enable(memory=True)
     model_res = defaultdict(lambda: np.zeros((101,0)))
     emg_res = defaultdict(lambda: np.zeros((1000,0)))
     model_delta_t = defaultdict(lambda: [])
@@ -88,7 +94,8 @@ def main():
             print('Reading file %s ...' % fname)
             full_name = DATA_FLDR + '/' + fname
             try:
-                data, cycles = collect_trial_data(full_name, analog_envelope=False, force_collect_all_cycles=False, fp_cycles_only=True)
+                with stageprof.stage('collect_trial_data'):
+                    data, cycles = collect_trial_data(full_name, analog_envelope=False, force_collect_all_cycles=False, fp_cycles_only=True)
 
                 for var_name in MODEL_VAR_NAMES:
                     try:
@@ -121,11 +128,14 @@ def main():
 
 
     # Compute the derivatives
-    for var_name in MODEL_VAR_NAMES_TO_DIFF:
-        model_res[var_name + '_dt'] = np.diff(model_res[var_name], axis=0) / np.array(model_delta_t[var_name])
-
-    scipy.io.savemat(MODEL_OUT_FNAME, model_res)
-    scipy.io.savemat(EMG_OUT_FNAME, emg_res)
+    with stageprof.stage('derivatives'):
+        for var_name in MODEL_VAR_NAMES_TO_DIFF:
+            model_res[var_name + '_dt'] = np.diff(model_res[var_name], axis=0) / np.array(model_delta_t[var_name])
+
+    with stageprof.stage('savemat'):
+        scipy.io.savemat(MODEL_OUT_FNAME, model_res)
+        scipy.io.savemat(EMG_OUT_FNAME, emg_res)
+    stageprof.report(PROFILE_OUT_FNAME)
 
 
 if __name__ == '__main__':
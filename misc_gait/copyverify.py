@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel, verified and resumable copy of session directories.
+
+Files are copied by a pool of threads. The SHA-256 of each file is computed
+from the data as it is copied, so the source is read only once. The state of
+the copy is kept in a manifest (copy_manifest.json) in the destination
+directory: for each copied file, the size and mtime of the source and the
+hash. The manifest is saved periodically while copying (every
+MANIFEST_SAVE_FILES files or MANIFEST_SAVE_INTERVAL seconds) and at the end,
+so an interrupted copy can be resumed by calling copy_tree() again; only
+files that are missing or have changed (or were copied after the last save)
+are then copied. Files are copied into temporary *.copy.tmp files, which are
+removed if the copy fails or was interrupted.
+
+After copying, the destination files are read back and checked against the
+sizes and hashes in the manifest. The manifest is marked as verified only if
+all files match. is_verified() checks this, and also that the source has not
+changed since; use it before deleting the source.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import time
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FNAME = 'copy_manifest.json'
+# increase when the manifest format changes
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 4 * 2**20
+# a moderate number of threads is enough to saturate a network drive
+MAX_WORKERS = 8
+# save the manifest during the copy after this many files or seconds
+MANIFEST_SAVE_FILES = 50
+MANIFEST_SAVE_INTERVAL = 10.0
+TMP_SUFFIX = '.copy.tmp'
+
+
+def _source_files(srcdir):
+    """Return relative paths (as posix strings) of all files under srcdir"""
+    return sorted(
+        p.relative_to(srcdir).as_posix()
+        for p in srcdir.rglob('*')
+        if p.is_file() and p.name != MANIFEST_FNAME
+    )
+
+
+def _source_state(fname):
+    """Identify the state of a source file"""
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime_ns
+
+
+def _hash_file(fname):
+    """Return size and SHA-256 of a file"""
+    h = hashlib.sha256()
+    size = 0
+    with open(fname, 'rb') as fh:
+        while chunk := fh.read(CHUNK_SIZE):
+            h.update(chunk)
+            size += len(chunk)
+    return size, h.hexdigest()
+
+
+def _copy_file(src, dst):
+    """Copy a file, hashing the data on the way; return size and SHA-256.
+
+    The data is written into a temporary file that is renamed when complete,
+    so an interrupted copy leaves no partial file under the final name.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    dst_tmp = dst.with_name(dst.name + TMP_SUFFIX)
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(src, 'rb') as fsrc, open(dst_tmp, 'wb') as fdst:
+            while chunk := fsrc.read(CHUNK_SIZE):
+                h.update(chunk)
+                fdst.write(chunk)
+                size += len(chunk)
+        shutil.copystat(src, dst_tmp)
+        os.replace(dst_tmp, dst)
+    except BaseException:
+        dst_tmp.unlink(missing_ok=True)
+        raise
+    return size, h.hexdigest()
+
+
+def _remove_tmp_files(destdir):
+    """Remove temporary files left over by an interrupted copy"""
+    for fname in destdir.rglob('*' + TMP_SUFFIX):
+        logger.info(f'removing leftover temporary file {fname}')
+        fname.unlink(missing_ok=True)
+
+
+def _read_manifest(destdir):
+    try:
+        with open(destdir / MANIFEST_FNAME, encoding='utf-8') as fh:
+            manifest = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _write_manifest(destdir, manifest):
+    """Write the manifest, given as a dict or as JSON text"""
+    if not isinstance(manifest, str):
+        manifest = json.dumps(manifest, indent=1)
+    fname = destdir / MANIFEST_FNAME
+    fname_tmp = fname.with_name(fname.name + TMP_SUFFIX)
+    with open(fname_tmp, 'w', encoding='utf-8') as fh:
+        fh.write(manifest)
+    os.replace(fname_tmp, fname)
+
+
+def _is_current(entry, src):
+    """Whether a manifest entry matches the current state of the source"""
+    return entry is not None and tuple(entry['source']) == _source_state(src)
+
+
+def verify_tree(destdir, manifest, max_workers=MAX_WORKERS):
+    """Check the destination files against the manifest.
+
+    Returns a list of relative paths that are missing or do not match.
+    """
+
+    def _check(relpath):
+        entry = manifest['files'][relpath]
+        dst = destdir / relpath
+        try:
+            if dst.stat().st_size != entry['size']:
+                return relpath
+            size, digest = _hash_file(dst)
+        except OSError:
+            return relpath
+        if size != entry['size'] or digest != entry['sha256']:
+            return relpath
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_check, sorted(manifest['files']))
+    return [relpath for relpath in results if relpath is not None]
+
+
+def copy_tree(srcdir, destdir, max_workers=MAX_WORKERS):
+    """Copy a directory tree and verify the copy.
+
+    If destdir contains a manifest from an earlier (e.g. interrupted) copy,
+    files that were already copied and have not changed since are skipped.
+    Raises RuntimeError if any file could not be copied or verified; the
+    copy can then be resumed by calling copy_tree() again.
+
+    Parameters
+    ----------
+    srcdir : str | Path
+        The source directory.
+    destdir : str | Path
+        The destination directory; created if needed.
+    max_workers : int
+        Number of copy threads.
+
+    Returns
+    -------
+    manifest : dict
+        The verified manifest.
+    """
+    srcdir, destdir = Path(srcdir), Path(destdir)
+    destdir.mkdir(parents=True, exist_ok=True)
+    _remove_tmp_files(destdir)
+    manifest = _read_manifest(destdir) or {
+        'version': MANIFEST_VERSION,
+        'files': dict(),
+    }
+    manifest['verified'] = False
+    relpaths = _source_files(srcdir)
+    # drop files that no longer exist in the source
+    manifest['files'] = {
+        relpath: entry
+        for relpath, entry in manifest['files'].items()
+        if (srcdir / relpath).is_file()
+    }
+    todo = [
+        relpath
+        for relpath in relpaths
+        if not (
+            _is_current(manifest['files'].get(relpath), srcdir / relpath)
+            and (destdir / relpath).is_file()
+        )
+    ]
+    # also create empty directories, as copytree does
+    for p in srcdir.rglob('*'):
+        if p.is_dir():
+            (destdir / p.relative_to(srcdir)).mkdir(parents=True, exist_ok=True)
+    logger.info(
+        f'{srcdir.name}: copying {len(todo)} of {len(relpaths)} files to {destdir}'
+    )
+    lock = threading.Lock()  # guards manifest and failed
+    save_lock = threading.Lock()  # only one thread saves the manifest
+    failed = list()
+    n_unsaved = 0
+    t_saved = time.monotonic()
+
+    def _save_if_due():
+        """Save the manifest, if enough files or time have passed"""
+        nonlocal n_unsaved, t_saved
+        with lock:
+            due = (
+                n_unsaved >= MANIFEST_SAVE_FILES
+                or time.monotonic() - t_saved >= MANIFEST_SAVE_INTERVAL
+            )
+        # if another thread is saving, leave it to that thread
+        if not due or not save_lock.acquire(blocking=False):
+            return
+        try:
+            with lock:
+                text = json.dumps(manifest, indent=1)
+                n_unsaved = 0
+                t_saved = time.monotonic()
+            # write without holding the lock, so other threads can continue
+            _write_manifest(destdir, text)
+        finally:
+            save_lock.release()
+
+    def _copy(relpath):
+        nonlocal n_unsaved
+        src = srcdir / relpath
+        try:
+            state = _source_state(src)
+            size, digest = _copy_file(src, destdir / relpath)
+            if _source_state(src) != state or size != state[0]:
+                raise RuntimeError('source changed during copy')
+        except (OSError, RuntimeError) as e:
+            logger.warning(f'cannot copy {src}: {e}')
+            with lock:
+                failed.append(relpath)
+            return
+        with lock:
+            manifest['files'][relpath] = {
+                'source': list(state),
+                'size': size,
+                'sha256': digest,
+            }
+            n_unsaved += 1
+        _save_if_due()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_copy, todo))
+    finally:
+        # also saves the progress of an interrupted copy
+        _write_manifest(destdir, manifest)
+    if failed:
+        raise RuntimeError(f'{srcdir.name}: could not copy {failed}')
+
+    if bad := verify_tree(destdir, manifest, max_workers=max_workers):
+        # forget the bad files, so that they are copied again on resume
+        for relpath in bad:
+            manifest['files'].pop(relpath, None)
+        _write_manifest(destdir, manifest)
+        raise RuntimeError(f'{srcdir.name}: verification failed for {bad}')
+    manifest['verified'] = True
+    _write_manifest(destdir, manifest)
+    return manifest
+
+
+def is_verified(srcdir, destdir):
+    """Check that destdir holds a verified copy of the current srcdir.
+
+    Only the manifest and the state (size, mtime) of the source files are
+    checked; the destination is not read again.
+    """
+    srcdir, destdir = Path(srcdir), Path(destdir)
+    if (manifest := _read_manifest(destdir)) is None or not manifest['verified']:
+        return False
+    relpaths = _source_files(srcdir)
+    return set(relpaths) == set(manifest['files']) and all(
+        _is_current(manifest['files'][relpath], srcdir / relpath)
+        for relpath in relpaths
+    )
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Resolve EMG channel contexts (L/R) from a device layout config.
+
+The layouts and subject-specific overrides are read from a config file (by
+default emg_channels.cfg next to this module). Channel names are parsed only
+the first time they are seen for a given layout; after that, the context is
+a dict lookup.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import ast
+import configparser
+import os.path as op
+
+
+DEFAULT_CFG = op.join(op.dirname(op.abspath(__file__)), 'emg_channels.cfg')
+
+
+class ChannelContextResolver:
+    """Map EMG channel names to contexts.
+
+    Parameters
+    ----------
+    cfgfile : str, optional
+        The config file. Default is DEFAULT_CFG.
+    """
+
+    def __init__(self, cfgfile=None):
+        parser = configparser.ConfigParser(inline_comment_prefixes=('#',))
+        with open(cfgfile or DEFAULT_CFG, encoding='utf-8') as fh:
+            parser.read_file(fh)
+        cfg_ = {
+            section: {item: ast.literal_eval(val) for item, val in parser[section].items()}
+            for section in parser.sections()
+        }
+        general = cfg_.pop('general')
+        self.layouts = cfg_
+        self.default_layout = general['default_layout']
+        self.subject_layouts = {
+            subj.upper(): layout for subj, layout in general['subject_layouts'].items()
+        }
+        for layout in [self.default_layout] + list(self.subject_layouts.values()):
+            if layout not in self.layouts:
+                raise ValueError('undefined EMG layout %s' % layout)
+        # compiled channel name -> context tables, one per layout
+        self._tables = {layout: dict() for layout in self.layouts}
+
+    def layout_for(self, subject):
+        """Return the layout name for a subject"""
+        return self.subject_layouts.get((subject or '').upper(), self.default_layout)
+
+    def _parse(self, chname, layout):
+        """Figure out channel context by parsing the channel name"""
+        spec = self.layouts[layout]
+        prefix = spec['prefix']
+        if spec['myon_naming'] and chname[0] in 'LR':
+            return chname[0]
+        elif chname.startswith(prefix):
+            idx = chname[len(prefix) :].split('.')[0]  # channel index
+            try:
+                return spec['index_contexts'].get(int(idx))
+            except ValueError:
+                raise ValueError('cannot parse channel name %s' % chname)
+        else:  # unrecognized channel
+            return None
+
+    def context(self, chname, layout):
+        """Return context for a channel, or None if it is not recognized"""
+        table = self._tables[layout]
+        if chname not in table:
+            table[chname] = self._parse(chname, layout)
+        return table[chname]
+
+    def contexts(self, chnames, subject=None):
+        """Return a dict of contexts for the recognized channels in chnames"""
+        layout = self.layout_for(subject)
+        return {
+            chname: ctxt
+            for chname in chnames
+            if (ctxt := self.context(chname, layout)) is not None
+        }
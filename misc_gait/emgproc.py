@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+"""
+EMG processing engine shared by the EMG scripts.
+
+Reads the EMG channels of a c3d file once and computes the rectified signal,
+the linear envelope and the RMS envelope. All channels are filtered together
+as a single (channels x samples) array.
+
+Also provides a batch runner which processes c3d files (envelopes, gait cycles
+and cycle normalization) in a process pool, and an on-disk cache for the
+computed envelopes.
+
+@author: Jussi (jnu@iki.fi)
+
+requires: gaitutils, numpy, scipy
+"""
+
+import os
+import os.path as op
+import glob
+import hashlib
+import inspect
+import functools
+import fractions
+import concurrent.futures
+import numpy as np
+import scipy.signal
+
+import gaitutils
+from gaitutils.envutils import GaitDataError
+from gaitutils import cfg, read_data
+
+import emgchannels
+import events
+import stageprof
+
+
+# default parameters for the rectified signal and linear envelope
+HPF = 5  # high pass frequency
+LPF = 10  # envelope low pass frequency
+BUTTER_ORDER = 4  # filter order
+# default parameters for the RMS envelope
+RMS_HPF = 20  # high pass frequency
+RMS_WIN = 31  # RMS window length (samples)
+# outputs that are normalized to gait cycles by process_trial_c3d()
+NORM_KINDS = ('linear_envelope', 'rms')
+
+
+@functools.lru_cache(maxsize=None)
+def _butter_sos(order, cutoff, rate, btype):
+    """Design a Butterworth filter as second-order sections.
+
+    Returns the sections and the padding length that filtfilt() would use for
+    the equivalent (b, a) filter, 3 * max(len(a), len(b)). The design is
+    cached, so each (order, cutoff, rate, btype) combination is only computed
+    once per process.
+    """
+    wn = cutoff * 2 / rate
+    b, a = scipy.signal.butter(order, wn, btype)
+    sos = scipy.signal.butter(order, wn, btype, output='sos')
+    return sos, 3 * max(len(a), len(b))
+
+
+def _filtfilt(data, order, cutoff, rate, btype):
+    """Zero-phase filter (channels x samples) data along the time axis.
+
+    The signal is padded as by filtfilt(b, a), so the edges of the output
+    match the earlier per-channel filtering.
+    """
+    sos, padlen = _butter_sos(order, cutoff, rate, btype)
+    return scipy.signal.sosfiltfilt(sos, data, axis=1, padlen=padlen)
+
+
+def _read_emg_c3d(c3dfile):
+    """Read EMG from a c3d file.
+
+    Returns a tuple of (chnames, data, emgrate, framerate, nframes) where data
+    is a (channels x samples) ndarray.
+    """
+    emgdata = read_data.get_emg_data(c3dfile)['data']
+    meta = read_data.get_metadata(c3dfile)
+    # strip Voltage. prefix that Nexus inserts
+    chnames = [
+        (chname[8:] if chname.find('Voltage') == 0 else chname) for chname in emgdata
+    ]
+    data = np.array(list(emgdata.values()), dtype=float)
+    return chnames, data, meta['analograte'], meta['framerate'], meta['length']
+
+
+def _resample_method(emgrate, framerate):
+    """Choose a resampling method for the given analog and frame rates.
+
+    Returns a tuple of (method, up, down).
+    """
+    ratio = fractions.Fraction(framerate).limit_denominator(
+        1000
+    ) / fractions.Fraction(emgrate).limit_denominator(1000)
+    if ratio.numerator == 1:
+        return 'decimate', 1, ratio.denominator
+    elif max(ratio.numerator, ratio.denominator) <= 1000:
+        return 'poly', ratio.numerator, ratio.denominator
+    else:
+        return 'fft', None, None
+
+
+def _fit_length(data, nframes):
+    """Trim or edge-pad (channels x samples) data to nframes samples"""
+    if data.shape[1] >= nframes:
+        return data[:, :nframes]
+    return np.pad(data, ((0, 0), (0, nframes - data.shape[1])), mode='edge')
+
+
+def downsample(data, nframes, emgrate, framerate, method='auto'):
+    """Downsample (channels x samples) analog data to marker frames.
+
+    Parameters
+    ----------
+    data : ndarray
+        (channels x samples) array of analog data.
+    nframes : int
+        Number of marker frames.
+    emgrate : float
+        Analog sampling rate (Hz).
+    framerate : float
+        Marker frame rate (Hz).
+    method : str, optional
+        'fft' for FFT-based resampling (scipy.signal.resample), 'poly' for
+        polyphase filtering with the rational rate ratio, 'decimate' for
+        decimation by an integer factor or 'auto' to pick decimation or
+        polyphase filtering according to the rate ratio.
+
+    Returns
+    -------
+    ndarray
+        (channels x nframes) array of downsampled data.
+    """
+    auto_method, up, down = _resample_method(emgrate, framerate)
+    if method == 'auto':
+        method = auto_method
+    if method == 'fft':
+        return scipy.signal.resample(data, nframes, axis=1)
+    elif method == 'poly':
+        if up is None:
+            raise ValueError('no suitable rational ratio for polyphase resampling')
+        data_ds = scipy.signal.resample_poly(data, up, down, axis=1, padtype='line')
+    elif method == 'decimate':
+        if auto_method != 'decimate':
+            raise ValueError('analog rate is not an integer multiple of frame rate')
+        # polyphase FIR decimator; unlike scipy.signal.decimate(), this pads
+        # the edges by line extrapolation, which avoids droop at the ends
+        data_ds = scipy.signal.resample_poly(data, 1, down, axis=1, padtype='line')
+    else:
+        raise ValueError('invalid resampling method %s' % method)
+    return _fit_length(data_ds, nframes)
+
+
+def compute_emg(
+    data,
+    emgrate,
+    framerate,
+    nframes,
+    hpf=HPF,
+    lpf=LPF,
+    rms_hpf=RMS_HPF,
+    rms_win=RMS_WIN,
+    butter_order=BUTTER_ORDER,
+    resample_method='auto',
+):
+    """Compute rectified signal, linear envelope and RMS envelope.
+
+    Parameters
+    ----------
+    data : ndarray
+        (channels x samples) array of raw EMG.
+    emgrate : float
+        EMG sampling rate (Hz).
+    framerate : float
+        Marker frame rate (Hz).
+    nframes : int
+        Number of marker frames to downsample to.
+    resample_method : str, optional
+        Downsampling method; see downsample().
+
+    Returns
+    -------
+    dict
+        Keys are 'rectified', 'linear_envelope' and 'rms'; values are
+        (channels x nframes) ndarrays.
+    """
+    # rectified signal and linear envelope
+    emg_rectified = np.abs(_filtfilt(data, butter_order, hpf, emgrate, 'high'))
+    emg_lenv = _filtfilt(emg_rectified, butter_order, lpf, emgrate, 'low')
+    # RMS envelope has its own highpass
+    emg_hpf_rms = _filtfilt(data, butter_order, rms_hpf, emgrate, 'high')
+    emg_rms = gaitutils.numutils.rms(emg_hpf_rms, rms_win, axis=1)
+    # downsample to marker frames
+    _downsample = functools.partial(
+        downsample,
+        nframes=nframes,
+        emgrate=emgrate,
+        framerate=framerate,
+        method=resample_method,
+    )
+    return {
+        'rectified': _downsample(emg_rectified),
+        'linear_envelope': _downsample(emg_lenv),
+        'rms': _downsample(emg_rms),
+    }
+
+
+def effective_params(params):
+    """Return compute_emg() parameters with defaults filled in for params"""
+    params_ = {
+        name: par.default
+        for name, par in inspect.signature(compute_emg).parameters.items()
+        if par.default is not inspect.Parameter.empty
+    }
+    params_.update(params)
+    return params_
+
+
+class EnvelopeCache:
+    """On-disk cache for the outputs of compute_emg_c3d().
+
+    Entries are stored as .npz files. The key is computed from the c3d path,
+    modification time and size, and all the processing parameters. Thus a
+    modified c3d file or a changed parameter results in a cache miss, while
+    other entries remain valid. When the total size of the cache exceeds
+    max_bytes, least recently used entries are removed.
+
+    Parameters
+    ----------
+    cachedir : str
+        Directory for the cache files. Created if it does not exist.
+    max_bytes : int, optional
+        Maximum total size of the cache.
+    """
+
+    def __init__(self, cachedir, max_bytes=2**30):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        os.makedirs(cachedir, exist_ok=True)
+
+    def _key(self, c3dfile, params):
+        st = os.stat(c3dfile)
+        # include defaults, so that changing a default also invalidates entries
+        keytxt = repr(
+            (
+                op.abspath(c3dfile),
+                st.st_mtime_ns,
+                st.st_size,
+                sorted(effective_params(params).items()),
+            )
+        )
+        return hashlib.sha1(keytxt.encode('utf-8')).hexdigest()
+
+    def _fname(self, key):
+        return op.join(self.cachedir, key + '.npz')
+
+    def get(self, c3dfile, params):
+        """Return cached results, or None if not found"""
+        fname = self._fname(self._key(c3dfile, params))
+        try:
+            with np.load(fname) as npz:
+                res = {kind: npz[kind] for kind in npz.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        res['chnames'] = res['chnames'].tolist()
+        # mark as recently used
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            pass
+        return res
+
+    def put(self, c3dfile, params, res):
+        """Store results into the cache"""
+        fname = self._fname(self._key(c3dfile, params))
+        # write to a temporary file first, since several processes may be
+        # using the cache at the same time
+        fname_tmp = '%s.%d.tmp.npz' % (fname[:-4], os.getpid())
+        np.savez(fname_tmp, **res)
+        os.replace(fname_tmp, fname)
+        self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until under the size limit"""
+        entries = list()
+        for fname in glob.glob(op.join(self.cachedir, '*.npz')):
+            if fname.endswith('.tmp.npz'):
+                continue
+            try:
+                st = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def compute_emg_c3d(c3dfile, cache=None, **params):
+    """Read EMG from a c3d file once and compute all outputs.
+
+    Keyword arguments are passed to compute_emg(). Returns the dict from
+    compute_emg() with the additional key 'chnames', which gives the channel
+    names in row order. If cache (an EnvelopeCache instance) is given, results
+    are read from and stored into it.
+    """
+    if cache is not None:
+        with stageprof.stage('envelope cache read'):
+            res = cache.get(c3dfile, params)
+        if res is not None:
+            return res
+    with stageprof.stage('read EMG'):
+        chnames, data, emgrate, framerate, nframes = _read_emg_c3d(c3dfile)
+    with stageprof.stage('filter EMG'):
+        res = compute_emg(data, emgrate, framerate, nframes, **params)
+    res['chnames'] = chnames
+    if cache is not None:
+        with stageprof.stage('envelope cache write'):
+            cache.put(c3dfile, params, res)
+    return res
+
+
+def channel_dict(res, kind, suffix=''):
+    """Convert one output of compute_emg_c3d() into a dict keyed by channel"""
+    return {chname + suffix: chdata for chname, chdata in zip(res['chnames'], res[kind])}
+
+
+def normalize_cycles(data, starts, ends, npts=101):
+    """Normalize multichannel data to gait cycles in a single pass.
+
+    The interpolation is equivalent to Gaitcycle.normalize(): each cycle
+    data[:, start:end] is linearly interpolated to npts points spanning
+    0..100% of the cycle.
+
+    Parameters
+    ----------
+    data : ndarray
+        (channels x frames) array of frame-based data.
+    starts : array_like
+        Starting frame of each cycle.
+    ends : array_like
+        Ending frame (exclusive) of each cycle.
+    npts : int, optional
+        Number of points in the normalized cycle.
+
+    Returns
+    -------
+    ndarray
+        (channels x cycles x npts) array of normalized data.
+    """
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    if np.any(ends > data.shape[1]):
+        raise GaitDataError('Cycle frame numbers exceed the available data')
+    # fractional frame index of each normalized point, (cycles x npts)
+    pos = starts[:, None] + np.linspace(0, 1, npts) * (ends - starts - 1)[:, None]
+    ind0 = np.clip(np.floor(pos).astype(int), starts[:, None], (ends - 2)[:, None])
+    frac = pos - ind0
+    return data[:, ind0] * (1 - frac) + data[:, ind0 + 1] * frac
+
+
+def find_c3ds(rootdir):
+    """Return a sorted list of all c3d files under rootdir"""
+    allfiles = list()
+    for d0, dirs, files in os.walk(rootdir):
+        allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
+    return sorted(allfiles)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_resolver():
+    """Return the channel context resolver for the default config"""
+    return emgchannels.ChannelContextResolver()
+
+
+def process_trial_c3d(c3dfile, cache=None, resolver=None, **params):
+    """Compute EMG envelopes for a c3d trial and normalize them to gait cycles.
+
+    Keyword arguments are passed to compute_emg(). If cache (an EnvelopeCache
+    instance) is given, envelopes are read from and stored into it. resolver
+    is an emgchannels.ChannelContextResolver instance that determines the
+    channel contexts; default is one using the default config. Returns None if EMG cannot be
+    read from the file. Otherwise returns a dict with keys:
+
+    c3dfile : str
+        The file name.
+    ncycles : dict
+        Number of gait cycles per context.
+    contexts : dict
+        Context of each recognized channel.
+    norm : dict
+        For each kind in NORM_KINDS, a dict keyed by channel name whose values
+        are (cycles x 101) arrays of normalized data. Only cycles matching the
+        channel context are included.
+    avg : dict
+        Same as norm, but for the average over cycles.
+    std : dict
+        Same as norm, but for the standard deviation over cycles.
+    """
+    try:
+        res = compute_emg_c3d(c3dfile, cache=cache, **params)
+    except GaitDataError:
+        return None
+    # gait cycles from the event index, so the trial is loaded only if needed
+    with stageprof.stage('event index'):
+        evindex = events.get_index(c3dfile)
+    cycle_contexts = [
+        ctxt for ctxt in 'LR' for _ in range(len(evindex.cycles[ctxt]['start']))
+    ]
+    # count L/R cycles
+    ncycles = {ctxt: len(evindex.cycles[ctxt]['start']) for ctxt in 'LR'}
+    # channel mapping depends on the device layout, which may be overridden
+    # per subject
+    if resolver is None:
+        resolver = _default_resolver()
+    contexts = resolver.contexts(res['chnames'], evindex.subject_name)
+    chnames = [chname for chname in res['chnames'] if chname in contexts]
+    inds = [res['chnames'].index(chname) for chname in chnames]
+    starts = np.concatenate([evindex.cycles[ctxt]['start'] for ctxt in 'LR'])
+    ends = np.concatenate([evindex.cycles[ctxt]['end'] for ctxt in 'LR'])
+    norm, avg, std = dict(), dict(), dict()
+    for kind in NORM_KINDS:
+        norm[kind], avg[kind], std[kind] = dict(), dict(), dict()
+        # (channels x cycles x 101)
+        with stageprof.stage('normalize cycles'):
+            ndata = normalize_cycles(res[kind][inds], starts, ends)
+        # all channels of a given context share the same cycles
+        for ctxt in 'LR':
+            ch_mask = np.array([contexts[ch] == ctxt for ch in chnames], dtype=bool)
+            cyc_mask = np.array([c == ctxt for c in cycle_contexts], dtype=bool)
+            ndata_ctxt = ndata[ch_mask][:, cyc_mask]
+            ch_avg = ndata_ctxt.mean(axis=1)
+            ch_std = ndata_ctxt.std(axis=1)
+            chnames_ctxt = [ch for ch in chnames if contexts[ch] == ctxt]
+            for k, chname in enumerate(chnames_ctxt):
+                norm[kind][chname] = ndata_ctxt[k]
+                avg[kind][chname] = ch_avg[k]
+                std[kind][chname] = ch_std[k]
+    return {
+        'c3dfile': c3dfile,
+        'ncycles': ncycles,
+        'contexts': contexts,
+        'norm': norm,
+        'avg': avg,
+        'std': std,
+    }
+
+
+def _apply_cfg(cfg_overrides):
+    """Apply config overrides, given as {section: {item: value}}"""
+    for section, items in cfg_overrides.items():
+        for item, value in items.items():
+            setattr(getattr(cfg, section), item, value)
+
+
+def _process_profiled(c3dfile, **params):
+    """Run process_trial_c3d() in a worker, returning also the profiling stats"""
+    res = process_trial_c3d(c3dfile, **params)
+    return res, stageprof.pop_stats() if stageprof.enabled else None
+
+
+def run_batch(c3dfiles, max_workers=None, cfg_overrides=None, **params):
+    """Process c3d files in a process pool.
+
+    Parameters
+    ----------
+    c3dfiles : list
+        The c3d files to process.
+    max_workers : int, optional
+        Number of worker processes. Default is the number of CPUs.
+    cfg_overrides : dict, optional
+        gaitutils config overrides, given as {section: {item: value}}. These are
+        applied in each worker process, since the workers do not see config
+        changes made in the parent process.
+
+    Keyword arguments are passed to process_trial_c3d().
+
+    Yields
+    ------
+    tuple
+        (c3dfile, result) in the order of c3dfiles, where result is the return
+        value of process_trial_c3d().
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_apply_cfg,
+        initargs=(cfg_overrides or dict(),),
+    ) as executor:
+        futures = [
+            executor.submit(_process_profiled, c3dfile, **params)
+            for c3dfile in c3dfiles
+        ]
+        for c3dfile, future in zip(c3dfiles, futures):
+            res, stats = future.result()
+            if stats:
+                stageprof.merge_stats(stats)
+            yield c3dfile, res
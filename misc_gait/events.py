@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Per-trial gait event index shared by the gait scripts.
+
+The index holds the foot strikes, toeoffs and gait cycles of a trial as sorted
+arrays for each context, and a table pairing each foot strike with the first
+following toeoff. It is built once from a gaitutils Trial and saved next to
+the c3d file (<trial>.events.npz), so that later runs can read the events
+without loading the trial. A saved index is rebuilt if the c3d file or the
+gaitutils config items that affect gait cycle detection have changed.
+
+Frames are 0-based, as in the gaitutils Trial, which has already removed the
+trial offset from the events. Strikes, toeoffs and cycles use the same frames.
+
+@author: Jussi (jnu@iki.fi)
+
+requires: gaitutils, numpy
+"""
+
+import os
+import os.path as op
+import logging
+import numpy as np
+
+from gaitutils import cfg, trial
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.events.npz'
+# increase when the stored format changes
+INDEX_VERSION = 2
+# config items (section, item) that affect the gait cycles
+CFG_ITEMS = [
+    ('trial', 'no_toeoff'),
+    ('trial', 'multiple_toeoffs'),
+    ('autoproc', 'nexus_forceplate_devnames'),
+]
+# per-cycle arrays; missing values are stored as -1
+CYCLE_FIELDS = ['start', 'end', 'toeoff', 'plate', 'index']
+
+
+def _source_signature(c3dfile):
+    """Identify the state of the source file"""
+    st = os.stat(c3dfile)
+    return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+
+def _cfg_key():
+    """Describe the config items that affect the gait cycles"""
+    return repr(
+        [getattr(getattr(cfg, section), item, None) for section, item in CFG_ITEMS]
+    )
+
+
+def toeoff_indices(strikes, toeoffs):
+    """Pair sorted foot strikes with the first following toeoff.
+
+    Returns the index into toeoffs for each strike, or -1 if no toeoff follows.
+    """
+    idx = np.searchsorted(toeoffs, strikes, side='right')
+    return np.where(idx < len(toeoffs), idx, -1)
+
+
+def select_paired(strikes, toeoffs, idx):
+    """Return paired strikes and toeoffs; unpaired strikes are dropped"""
+    paired = idx >= 0
+    for strike in strikes[~paired]:
+        logger.warning('No toeoff for foot strike at %d!' % strike)
+    return strikes[paired], toeoffs[idx[paired]]
+
+
+def pair_strikes(strikes, toeoffs):
+    """Pair each foot strike with the first toeoff after it.
+
+    The events need not be sorted. Returns the paired strikes and toeoffs as
+    arrays, in time order; strikes with no following toeoff are dropped.
+    """
+    strikes = np.sort(strikes)
+    toeoffs = np.sort(toeoffs)
+    return select_paired(strikes, toeoffs, toeoff_indices(strikes, toeoffs))
+
+
+class EventIndex:
+    """Gait events of a trial.
+
+    Parameters
+    ----------
+    strikes : dict
+        Foot strike frames for each context.
+    toeoffs : dict
+        Toeoff frames for each context.
+    cycles : dict
+        For each context, a dict of per-cycle arrays keyed by CYCLE_FIELDS.
+    framerate : float
+        Frame rate of the trial.
+    subject_name : str
+        Name of the subject.
+
+    Attributes
+    ----------
+    strikes, toeoffs : dict
+        Sorted event frames for each context.
+    toeoff_idx : dict
+        For each context and strike, the index into toeoffs of the first
+        toeoff after the strike, or -1 if there is none.
+    cycles : dict
+        Per-cycle arrays for each context, sorted by cycle start.
+    """
+
+    def __init__(self, strikes, toeoffs, cycles, framerate, subject_name):
+        self.framerate = float(framerate)
+        self.subject_name = str(subject_name)
+        self.strikes, self.toeoffs, self.toeoff_idx, self.cycles = {}, {}, {}, {}
+        for context in 'LR':
+            ctx_strikes = np.sort(np.asarray(strikes[context], dtype=int))
+            ctx_toeoffs = np.sort(np.asarray(toeoffs[context], dtype=int))
+            self.strikes[context] = ctx_strikes
+            self.toeoffs[context] = ctx_toeoffs
+            self.toeoff_idx[context] = toeoff_indices(ctx_strikes, ctx_toeoffs)
+            ctx_cycles = {
+                field: np.asarray(cycles[context][field], dtype=int)
+                for field in CYCLE_FIELDS
+            }
+            order = np.argsort(ctx_cycles['start'], kind='stable')
+            self.cycles[context] = {
+                field: vals[order] for field, vals in ctx_cycles.items()
+            }
+
+    @classmethod
+    def from_trial(cls, tr):
+        """Build the index from a gaitutils Trial"""
+        # Trial has already subtracted the offset from the events
+        strikes = {
+            'R': np.array(tr.rstrikes, dtype=int),
+            'L': np.array(tr.lstrikes, dtype=int),
+        }
+        toeoffs = {
+            'R': np.array(tr.rtoeoffs, dtype=int),
+            'L': np.array(tr.ltoeoffs, dtype=int),
+        }
+        cycles = dict()
+        for context in 'LR':
+            ctx_cycles = [cyc for cyc in tr.cycles if cyc.context == context]
+            cycles[context] = {
+                'start': [cyc.start for cyc in ctx_cycles],
+                'end': [cyc.end for cyc in ctx_cycles],
+                'toeoff': [
+                    -1 if cyc.toeoff is None else cyc.toeoff for cyc in ctx_cycles
+                ],
+                'plate': [
+                    cyc.plate_idx if cyc.on_forceplate else -1 for cyc in ctx_cycles
+                ],
+                'index': [
+                    -1 if cyc.index is None else cyc.index for cyc in ctx_cycles
+                ],
+            }
+        # subject_name exists only in newer gaitutils versions
+        subject_name = getattr(tr, 'subject_name', None) or tr.name
+        return cls(strikes, toeoffs, cycles, tr.framerate, subject_name)
+
+    def paired(self, context):
+        """Return paired strikes and toeoffs; unpaired strikes are dropped"""
+        return select_paired(
+            self.strikes[context], self.toeoffs[context], self.toeoff_idx[context]
+        )
+
+    def fp_cycles(self, context):
+        """Return per-cycle arrays for the forceplate cycles of a context"""
+        cycles = self.cycles[context]
+        on_fp = cycles['plate'] >= 0
+        return {field: vals[on_fp] for field, vals in cycles.items()}
+
+    def _arrays(self):
+        """All data as a dict of arrays, for saving"""
+        arrays = {
+            'framerate': np.array(self.framerate),
+            'subject_name': np.array(self.subject_name),
+        }
+        for context in 'LR':
+            arrays[context + '_strikes'] = self.strikes[context]
+            arrays[context + '_toeoffs'] = self.toeoffs[context]
+            for field, vals in self.cycles[context].items():
+                arrays['%s_cycle_%s' % (context, field)] = vals
+        return arrays
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        return cls(
+            {context: arrays[context + '_strikes'] for context in 'LR'},
+            {context: arrays[context + '_toeoffs'] for context in 'LR'},
+            {
+                context: {
+                    field: arrays['%s_cycle_%s' % (context, field)]
+                    for field in CYCLE_FIELDS
+                }
+                for context in 'LR'
+            },
+            arrays['framerate'],
+            arrays['subject_name'],
+        )
+
+
+def index_fname(c3dfile):
+    """Return the name of the index file for a c3d file"""
+    return op.splitext(c3dfile)[0] + INDEX_SUFFIX
+
+
+def save_index(index, c3dfile):
+    """Save the index next to the c3d file.
+
+    Failure to write (e.g. a read-only directory) is logged, but not raised.
+    """
+    fname = index_fname(c3dfile)
+    # write to a temporary file first, since several processes may be
+    # processing the same trial
+    fname_tmp = '%s.%d.tmp.npz' % (fname[:-4], os.getpid())
+    try:
+        np.savez(
+            fname_tmp,
+            version=np.array(INDEX_VERSION),
+            signature=_source_signature(c3dfile),
+            cfg_key=np.array(_cfg_key()),
+            **index._arrays(),
+        )
+        os.replace(fname_tmp, fname)
+    except OSError as e:
+        logger.warning('cannot save event index for %s: %s' % (c3dfile, e))
+
+
+def load_index(c3dfile):
+    """Load the saved index of a c3d file.
+
+    Returns None if there is no index, or if it is out of date.
+    """
+    try:
+        with np.load(index_fname(c3dfile)) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+    if (
+        arrays.get('version') != INDEX_VERSION
+        or not np.array_equal(arrays.get('signature'), _source_signature(c3dfile))
+        or arrays.get('cfg_key') != _cfg_key()
+    ):
+        return None
+    try:
+        return EventIndex._from_arrays(arrays)
+    except KeyError:
+        return None
+
+
+def get_index(c3dfile, tr=None):
+    """Return the event index of a c3d file.
+
+    A saved index is used if it is up to date. Otherwise, the index is built
+    from tr (a gaitutils Trial, loaded if not given) and saved.
+    """
+    if (index := load_index(c3dfile)) is not None:
+        return index
+    if tr is None:
+        tr = trial.Trial(c3dfile)
+    index = EventIndex.from_trial(tr)
+    save_index(index, c3dfile)
+    return index
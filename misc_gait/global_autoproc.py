@@ -12,7 +12,6 @@ import os
 from pathlib import Path
 import shutil
 import numpy as np
-import time
 import logging
 import datetime
 import sqlite3
@@ -24,13 +23,19 @@ from gaitutils import (
     nexus,
     cfg,
     autoprocess,
-    trial,
     videos,
     GaitDataError,
 )
 from gaitutils.report import web, pdf
 from ulstools.num import check_hetu
 
+import copyverify
+import nexusready
+import stageprof
+import trialmeta
+from sessionsched import SessionScheduler, Step
+from videoconv import ConversionManager
+
 # how many trials to tag per context
 MAX_TAGS_PER_CONTEXT = 3
 # root dir for copy destination
@@ -47,44 +52,38 @@ DIAGS_DIRS = {
 
 #logging.basicConfig(level=logging.DEBUG)
 
+# record time and memory use per processing stage; see the last cell
+PROFILE = False
+if PROFILE:
+    stageprof.enable()
 
-def _count_fp_contacts(trial):
-    """Return n of valid forceplate contacts"""
-    return len(trial.fp_events['L_strikes']) + len(trial.fp_events['R_strikes'])
+# shared by all sessions; caps the number of converter processes
+video_converter = ConversionManager()
 
 
-def _gait_direction(enffile):
-    """Quick and dirty gait direction from enffile, after autoprocessing.
+def _autotag(sessiondir):
+    """Automatically tag trials in a session dir.
 
-    XXX: fragile, relies on certain description string.
+    Direction and forceplate contacts are read from the session metadata
+    index (see _refresh_metadata()); only trials that are not up to date in
+    the index are loaded.
     """
-    keys = gaitutils.eclipse.get_eclipse_keys(enffile, 'Description')
-    thedesc = keys['DESCRIPTION']
-    for dir in 'ET':
-        if dir in thedesc:
-            return dir
-    return None
-
-
-def _autotag(sessiondir):
-    """Automatically tag trials in a session dir"""
     c3dfiles = gaitutils.sessionutils.get_c3ds(sessiondir, trial_type='dynamic')
-    trials = [trial.Trial(c3dfile) for c3dfile in c3dfiles]
-    enffiles = [tr.enfpath for tr in trials]
+    meta = trialmeta.SessionMetadata(sessiondir)
+    entries = [meta.get(c3dfile) for c3dfile in c3dfiles]
 
     for direction in 'ET':
-        enfs_thisdir = [
-            (k, enffile)
-            for (k, enffile) in enumerate(enffiles)
-            if _gait_direction(enffile) == direction
+        c3ds_thisdir = [
+            c3dfile
+            for (c3dfile, entry) in zip(c3dfiles, entries)
+            if entry['direction'] == direction
         ]
-        n_contacts = [_count_fp_contacts(trials[k]) for k, _ in enfs_thisdir]
-        best_inds = np.argsort(-np.array(n_contacts))
-        bestfiles = [enfs_thisdir[k][1] for k in best_inds]
-        for k, enffile in enumerate(bestfiles[:MAX_TAGS_PER_CONTEXT], 1):
-            gaitutils.eclipse.set_eclipse_keys(
-                enffile, {'NOTES': direction + str(k)}, update_existing=True
-            )
+        n_contacts = [meta.get(c3dfile)['fp_contacts'] for c3dfile in c3ds_thisdir]
+        best_inds = np.argsort(-np.array(n_contacts), kind='stable')
+        bestfiles = [c3ds_thisdir[k] for k in best_inds]
+        for k, c3dfile in enumerate(bestfiles[:MAX_TAGS_PER_CONTEXT], 1):
+            meta.set_notes(c3dfile, direction + str(k))
+    meta.save()
 
 
 def _get_patient_dir():
@@ -106,12 +105,35 @@ def _is_sessiondir(dir):
     return True
 
 
-def _run_postprocessing(c3dfiles):
-    """Helper function that will be run in a separate thread"""
-    nexus._close_trial()
-    for c3dfile in c3dfiles:
-        nexus._open_trial(c3dfile)
-        nexus._run_pipelines(cfg.autoproc.postproc_pipelines)
+def _autoproc(sessiondir):
+    """Autoprocess a session in Nexus"""
+    enffiles = sessionutils.get_enfs(sessiondir)
+    autoprocess._do_autoproc(enffiles, pipelines_in_proc=False)
+
+
+def _refresh_metadata(sessiondir):
+    """Update the trial metadata index from the autoprocessed trials"""
+    c3dfiles = sessionutils.get_c3ds(sessiondir, trial_type='dynamic')
+    trialmeta.SessionMetadata(sessiondir).refresh(c3dfiles)
+
+
+def _review_figs(sessiondir, backend):
+    """Create the review figures of a session"""
+    return [
+        gaitutils.viz.plots._plot_sessions(
+            sessiondir, layout=lout, backend=backend, figtitle=sessiondir.name
+        )
+        for lout in cfg.plot.review_layouts
+    ]
+
+
+def _convert_videos(sessiondir, redo=False):
+    """Convert the videos of a session, if needed"""
+    if not (
+        vidfiles := videos._collect_session_videos(sessiondir, tags=cfg.eclipse.tags)
+    ):
+        raise RuntimeError(f'Cannot find any video files for session {sessiondir}')
+    video_converter.convert(vidfiles, name=sessiondir.name, redo=redo)
 
 
 def _parse_name(name):
@@ -159,7 +181,12 @@ else:
     print(f'patient destination dir {destdir_patient} already exists')
     for sessiondir in session_dirs:
         sessiondir_dest = destdir_patient / sessiondir.name
-        if REQUIRE_DESTDIR_NOTEXIST and sessiondir_dest.is_dir():
+        # an interrupted copy (with a copy manifest) can be resumed
+        if (
+            REQUIRE_DESTDIR_NOTEXIST
+            and sessiondir_dest.is_dir()
+            and not (sessiondir_dest / copyverify.MANIFEST_FNAME).is_file()
+        ):
             raise RuntimeError(
                 f'session destination directory {sessiondir_dest} already exists!'
             )
@@ -167,53 +194,41 @@ else:
 
 
 # %%
-# 2: autoproc all
-for p in session_dirs:
-    enffiles = sessionutils.get_enfs(p)
-    autoprocess._do_autoproc(enffiles, pipelines_in_proc=False)
-print('*** autoproc complete')
-
-
-# %%
-# 3: autotag all
-for p in session_dirs:
-    _autotag(p)
-print('*** autotag complete')
-
+# 2-3: autoproc and autotag all
+# sessions are autoprocessed in Nexus one at a time; each session is indexed
+# and tagged while the next one is being autoprocessed
+# the scheduler records per-session step timings for all the cells below
+sched = SessionScheduler()
+sched.run(
+    session_dirs,
+    [
+        Step('autoproc', _autoproc, nexus=True),
+        Step('trial metadata', _refresh_metadata),
+        Step('autotag', _autotag),
+    ],
+)
+print('*** autoproc and autotag complete')
 
 
 # %%
 # 4: review the data
 REVIEW_BACKEND = 'plotly'
+# create the figures concurrently, show them in session order
+sched.run(
+    session_dirs,
+    [Step('review plots', lambda p: _review_figs(p, REVIEW_BACKEND))],
+)
 for p in session_dirs:
-    for lout in cfg.plot.review_layouts:
-        fig = gaitutils.viz.plots._plot_sessions(
-            p, layout=lout, backend=REVIEW_BACKEND, figtitle=p.name
-        )
+    for fig in sched.results[p.name, 'review plots']:
         gaitutils.viz.plot_misc.show_fig(fig)
 
 
 # %%
 # 5: run postproc. pipelines
-for sessiondir in session_dirs:
-
-    # restart Nexus for postproc pipelines
-    nexus._kill_nexus(restart=True)
-    time.sleep(30)  # might take a while
-
-    c3dfiles = sessionutils.get_c3ds(
-        sessiondir,
-        tags=cfg.eclipse.tags,
-        trial_type='dynamic',
-        check_if_exists=False,
-    )
-    c3dfiles += sessionutils.get_c3ds(
-        sessiondir, trial_type='static', check_if_exists=False
-    )
-    _run_postprocessing(c3dfiles)
-
-    print(f'Finished {sessiondir}')
-
+sched.run(
+    session_dirs,
+    [Step('postproc pipelines', nexusready.postprocess_session, nexus=True)],
+)
 print('*** Finished postprocessing pipelines')
 
 
@@ -246,38 +261,35 @@ for d in session_dirs:
 # %%
 
 # 7: generate reports
+# sessions are reported concurrently; the reports of a session are started as
+# soon as its videos are converted
+infos = dict()
 for sessiondir in session_dirs:
-
-    info = {
+    infos[sessiondir] = {
         'fullname': patient_name,
         'hetu': hetu,
         'session_description': session_desc[sessiondir],
     }
-    sessionutils.save_info(sessiondir, info)
-    if not (
-        vidfiles := videos._collect_session_videos(sessiondir, tags=cfg.eclipse.tags)
-    ):
-        raise RuntimeError(f'Cannot find any video files for session {sessiondir}')
-
-    if not videos.convert_videos(vidfiles, check_only=True):
-        # need to convert
-        if not (procs := videos.convert_videos(vidfiles=vidfiles)):
-            raise RuntimeError('video converter processes could not be started')
-
-        # wait in a sleep loop until all converter processes have finished
-        completed = False
-        _n_complete = -1
-        while not completed:
-            n_complete = len([p for p in procs if p.poll() is not None])
-            prog_txt = f'Converting videos: {n_complete} of {len(procs)} files done'
-            if _n_complete != n_complete:
-                print(prog_txt)
-                _n_complete = n_complete
-            time.sleep(1)
-            completed = n_complete == len(procs)
-
-    web.dash_report(sessions=[sessiondir], info=info, recreate_plots=True)
-    pdf.create_report(sessiondir, info, write_extracted=True, write_timedist=True)
+    sessionutils.save_info(sessiondir, infos[sessiondir])
+
+sched.run(
+    session_dirs,
+    [
+        Step('video conversion', _convert_videos),
+        Step(
+            'web report',
+            lambda p: web.dash_report(
+                sessions=[p], info=infos[p], recreate_plots=True
+            ),
+        ),
+        Step(
+            'pdf report',
+            lambda p: pdf.create_report(
+                p, infos[p], write_extracted=True, write_timedist=True
+            ),
+        ),
+    ],
+)
 
 print('*** Finished reports')
 
@@ -288,15 +300,17 @@ print('*** Finished reports')
 # kill Nexus so it doesn't get confused by the move operation
 nexus._kill_nexus()
 
+# files are copied in parallel and verified against their checksums; if the
+# copy is interrupted, rerunning the cell copies only the missing files
 copy_done = False
 for sessiondir in session_dirs:
     destdir = destdir_patient / sessiondir.name
     print(f'copying {sessiondir} -> {destdir}...')
-    shutil.copytree(sessiondir, destdir)
-    assert destdir.is_dir()
+    with stageprof.stage('copy'):
+        manifest = copyverify.copy_tree(sessiondir, destdir)
+    print(f'verified {len(manifest["files"])} files in {destdir}')
 copy_done = True
 
-# FIXME: should assert that copy really worked?
 print('*** Finished copying')
 
 
@@ -305,6 +319,9 @@ print('*** Finished copying')
 # set ALLOW_DELETE manually
 if copy_done and ALLOW_DELETE:
     assert rootdir.parent == Path('D:/ViconData/Clinical')
+    # the copies must be verified and the local data unchanged since
+    for sessiondir in session_dirs:
+        assert copyverify.is_verified(sessiondir, destdir_patient / sessiondir.name)
     shutil.rmtree(rootdir)
 
 
@@ -312,25 +329,20 @@ if copy_done and ALLOW_DELETE:
 
 REDO_ALL = True  # force conversion even if target files exist
 
-for sessiondir in session_dirs:
-    vidfiles = videos._collect_session_videos(sessiondir, tags=cfg.eclipse.tags)
-    if not vidfiles:
-        raise RuntimeError(f'Cannot find any video files for session {sessiondir}')
-
-    if REDO_ALL or not videos.convert_videos(vidfiles, check_only=True):
-        procs = videos.convert_videos(vidfiles=vidfiles)
-        if not procs:
-            raise RuntimeError('Video converter processes could not be started')
-        # wait in sleep loop until all converter processes have finished
-        completed = False
-        _n_complete = -1
-        while not completed:
-            n_complete = len([p for p in procs if p.poll() is not None])
-            prog_txt = f'Converting videos: {n_complete} of {len(procs)} files done'
-            if _n_complete != n_complete:
-                print(prog_txt)
-                _n_complete = n_complete
-            time.sleep(1)
-            completed = n_complete == len(procs)
+SessionScheduler().run(
+    session_dirs,
+    [Step('video conversion', lambda p: _convert_videos(p, redo=REDO_ALL))],
+)
 
 print('*** Finished video conversion')
+
+
+# %% profiling summary
+# time spent in each stage of the cells above
+print(sched.summary())
+if nexusready.restart_latencies:
+    print(
+        'Nexus restart latencies (s): '
+        + ', '.join(f'{t:.1f}' for t in nexusready.restart_latencies)
+    )
+stageprof.report(Path.home() / 'global_autoproc_profile.json')
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped marker store for repeated marker data queries.
+
+The point data of each c3d file in a session is unpacked once into a
+(frames x markers x 3) float32 array, with a label index and a
+(frames x markers) gap mask. The arrays are stored as .npy files in the
+marker_store subdirectory of the session and read back as memory maps, so
+later analyses do not need to parse the c3d files at all.
+
+get_marker_data() is a drop-in replacement for
+gaitutils.read_data.get_marker_data(): it returns the same _P, _V, _A and
+_gaps keys, read from the store if it is up to date and from the c3d file
+otherwise. The _P arrays are read-only views into the memory map. Note that
+stored positions are float32, while gaitutils returns float64.
+
+@author: Jussi (jnu@iki.fi)
+
+requires: gaitutils, numpy, ezc3d (for reading point labels)
+"""
+
+import os
+import os.path as op
+import glob
+import json
+import logging
+import numpy as np
+
+from gaitutils import read_data
+from gaitutils.envutils import GaitDataError
+
+logger = logging.getLogger(__name__)
+
+STORE_DIRNAME = 'marker_store'
+# increase when the stored format changes
+STORE_VERSION = 1
+
+
+def _store_fnames(c3dfile):
+    """Return names of the info, points and gaps files for a c3d file"""
+    sessiondir, fname = op.split(op.abspath(c3dfile))
+    base = op.join(sessiondir, STORE_DIRNAME, op.splitext(fname)[0])
+    return base + '.json', base + '.points.npy', base + '.gaps.npy'
+
+
+def _source_signature(c3dfile):
+    """Identify the state of the source file"""
+    st = os.stat(c3dfile)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _point_labels(c3dfile):
+    """Read the point labels of a c3d file"""
+    import ezc3d
+
+    acq = ezc3d.c3d(c3dfile)
+    return list(acq['parameters']['POINT']['LABELS']['value'])
+
+
+def convert_trial(c3dfile, markers=None):
+    """Unpack the point data of a c3d file into the store.
+
+    Parameters
+    ----------
+    c3dfile : str
+        The c3d file.
+    markers : list, optional
+        Markers to store. Default is all points in the file.
+    """
+    if markers is None:
+        markers = _point_labels(c3dfile)
+    mdata = read_data.get_marker_data(c3dfile, markers)
+    fname_info, fname_points, fname_gaps = _store_fnames(c3dfile)
+    os.makedirs(op.dirname(fname_info), exist_ok=True)
+    nframes = len(mdata[markers[0] + '_P'])
+    # write to temporary files first; the info file is written last, so an
+    # interrupted conversion leaves no valid entry
+    suffix = '.%d.tmp' % os.getpid()
+    points = np.lib.format.open_memmap(
+        fname_points + suffix,
+        mode='w+',
+        dtype=np.float32,
+        shape=(nframes, len(markers), 3),
+    )
+    gaps = np.zeros((nframes, len(markers)), dtype=bool)
+    for k, marker in enumerate(markers):
+        points[:, k, :] = mdata[marker + '_P']
+        gaps[mdata[marker + '_gaps'], k] = True
+    points.flush()
+    del points
+    with open(fname_gaps + suffix, 'wb') as fh:
+        np.save(fh, gaps)
+    info = {
+        'version': STORE_VERSION,
+        'signature': _source_signature(c3dfile),
+        'labels': markers,
+    }
+    with open(fname_info + suffix, 'w', encoding='utf-8') as fh:
+        json.dump(info, fh)
+    for fname in [fname_points, fname_gaps, fname_info]:
+        os.replace(fname + suffix, fname)
+
+
+def convert_session(sessiondir, markers=None):
+    """Unpack the point data of all c3d files in a session into the store.
+
+    Files whose store is up to date are skipped. Returns the number of files
+    converted.
+    """
+    nconverted = 0
+    for c3dfile in sorted(glob.glob(op.join(sessiondir, '*.c3d'))):
+        try:
+            MarkerStore(c3dfile)
+            continue
+        except (FileNotFoundError, ValueError):
+            pass
+        try:
+            convert_trial(c3dfile, markers)
+        except GaitDataError as e:
+            logger.warning('cannot read markers from %s: %s' % (c3dfile, e))
+            continue
+        nconverted += 1
+    return nconverted
+
+
+class MarkerStore:
+    """Stored point data of a c3d file.
+
+    Raises FileNotFoundError if there is no store for the file, and ValueError
+    if the store is out of date.
+
+    Parameters
+    ----------
+    c3dfile : str
+        The c3d file.
+
+    Attributes
+    ----------
+    labels : list
+        Marker names, in the order of the marker axis.
+    points : ndarray
+        Memory-mapped positions, (frames x markers x 3).
+    gaps : ndarray
+        Memory-mapped gap mask, (frames x markers).
+    """
+
+    def __init__(self, c3dfile):
+        fname_info, fname_points, fname_gaps = _store_fnames(c3dfile)
+        with open(fname_info, encoding='utf-8') as fh:
+            info = json.load(fh)
+        if (
+            info.get('version') != STORE_VERSION
+            or info.get('signature') != _source_signature(c3dfile)
+        ):
+            raise ValueError('marker store for %s is out of date' % c3dfile)
+        self.labels = info['labels']
+        self._label_idx = {label: k for k, label in enumerate(self.labels)}
+        self.points = np.load(fname_points, mmap_mode='r')
+        self.gaps = np.load(fname_gaps, mmap_mode='r')
+
+    def __contains__(self, marker):
+        return marker in self._label_idx
+
+    def get_marker_data(self, markers, ignore_missing=False):
+        """Return marker data in the format of read_data.get_marker_data()"""
+        mdata = dict()
+        for marker in markers:
+            if marker not in self._label_idx:
+                if ignore_missing:
+                    logger.warning('cannot read marker %s' % marker)
+                    continue
+                raise GaitDataError('cannot read marker %s' % marker)
+            k = self._label_idx[marker]
+            pos = self.points[:, k, :]
+            vel = np.gradient(pos, axis=0)
+            mdata[marker + '_P'] = pos
+            mdata[marker + '_V'] = vel
+            mdata[marker + '_A'] = np.gradient(vel, axis=0)
+            mdata[marker + '_gaps'] = np.flatnonzero(self.gaps[:, k])
+        return mdata
+
+
+def get_marker_data(c3dfile, markers):
+    """Read marker data, from the store if possible.
+
+    The store is used if it is up to date and contains all the markers;
+    otherwise the c3d file is read by gaitutils.
+    """
+    try:
+        store = MarkerStore(c3dfile)
+    except (FileNotFoundError, ValueError):
+        store = None
+    if store is not None and all(marker in store for marker in markers):
+        return store.get_marker_data(markers)
+    return read_data.get_marker_data(c3dfile, markers)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sessiondir = u'Z:/siirto/Running/'
+    n = convert_session(sessiondir)
+    logger.info('converted %d trials' % n)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Nexus restart with readiness probing.
+
+restart_nexus() restarts Nexus and then probes the SDK connection until
+Nexus answers, instead of sleeping for a fixed time. The probe interval
+starts short and grows up to a limit; if Nexus does not answer within the
+timeout, RuntimeError is raised. The restart latencies (time from restart
+until Nexus answered) are collected in restart_latencies.
+
+postprocess_session() restarts Nexus and runs the postprocessing pipelines
+(cfg.autoproc.postproc_pipelines) for the trials of a session.
+
+The functions take an api argument: the gaitutils.nexus module by default.
+FakeNexus implements the same interface with a simulated startup time, so
+that the restart and postprocessing can be run without Nexus, e.g. on Linux.
+See tests/test_nexusready.py.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import time
+import logging
+
+import stageprof
+
+logger = logging.getLogger(__name__)
+
+# probe timing (s)
+PROBE_INITIAL_DELAY = 0.5
+PROBE_MAX_DELAY = 5.0
+PROBE_BACKOFF = 1.5
+RESTART_TIMEOUT = 120.0
+
+# latency (s) of each restart by restart_nexus()
+restart_latencies = list()
+
+
+def _default_api():
+    # imported here, so that the fake API can be used without gaitutils
+    from gaitutils import nexus
+
+    return nexus
+
+
+def _postproc_pipelines():
+    from gaitutils import cfg
+
+    return cfg.autoproc.postproc_pipelines
+
+
+def _postproc_c3dfiles(sessiondir):
+    """Return the c3d files of a session that are postprocessed"""
+    from gaitutils import cfg, sessionutils
+
+    c3dfiles = sessionutils.get_c3ds(
+        sessiondir,
+        tags=cfg.eclipse.tags,
+        trial_type='dynamic',
+        check_if_exists=False,
+    )
+    c3dfiles += sessionutils.get_c3ds(
+        sessiondir, trial_type='static', check_if_exists=False
+    )
+    return c3dfiles
+
+
+def nexus_is_ready(api=None):
+    """Check whether Nexus answers on the SDK connection"""
+    api = api or _default_api()
+    try:
+        vicon = api.viconnexus()
+        vicon.GetTrialName()
+    # the SDK raises various errors when Nexus is not (yet) running
+    except Exception as e:
+        logger.debug(f'Nexus not ready: {e!r}')
+        return False
+    return True
+
+
+def wait_until_ready(
+    api=None,
+    timeout=RESTART_TIMEOUT,
+    initial_delay=PROBE_INITIAL_DELAY,
+    max_delay=PROBE_MAX_DELAY,
+    backoff=PROBE_BACKOFF,
+):
+    """Probe Nexus until it answers.
+
+    The first probe is made after initial_delay, and the delay is multiplied
+    by backoff after each failed probe, up to max_delay. Returns the time
+    (s) until Nexus answered. Raises RuntimeError on timeout.
+    """
+    api = api or _default_api()
+    t0 = time.monotonic()
+    delay = initial_delay
+    while True:
+        remaining = timeout - (time.monotonic() - t0)
+        if remaining <= 0:
+            raise RuntimeError(f'Nexus did not answer within {timeout:.1f} s')
+        time.sleep(min(delay, remaining))
+        if nexus_is_ready(api):
+            return time.monotonic() - t0
+        delay = min(delay * backoff, max_delay)
+
+
+def restart_nexus(api=None, timeout=RESTART_TIMEOUT):
+    """Restart Nexus and wait until it answers; return the latency (s)"""
+    api = api or _default_api()
+    t0 = time.monotonic()
+    api._kill_nexus(restart=True)
+    wait_until_ready(api, timeout=timeout - (time.monotonic() - t0))
+    latency = time.monotonic() - t0
+    restart_latencies.append(latency)
+    logger.info(f'Nexus restarted in {latency:.1f} s')
+    return latency
+
+
+def run_postprocessing(c3dfiles, api=None):
+    """Run the postprocessing pipelines for each of c3dfiles in Nexus"""
+    api = api or _default_api()
+    pipelines = _postproc_pipelines()
+    api._close_trial()
+    for c3dfile in c3dfiles:
+        api._open_trial(c3dfile)
+        api._run_pipelines(pipelines)
+
+
+def postprocess_session(sessiondir, api=None):
+    """Run the postprocessing pipelines for a session in a restarted Nexus"""
+    api = api or _default_api()
+    # restart Nexus for postproc pipelines; waits until Nexus answers
+    with stageprof.stage('restart Nexus'):
+        restart_nexus(api)
+    run_postprocessing(_postproc_c3dfiles(sessiondir), api)
+
+
+class FakeNexus:
+    """Stand-in for the gaitutils.nexus API, for testing without Nexus.
+
+    Implements the parts of the API used by the autoprocessing scripts.
+    After a restart, the SDK connection fails until startup_time has passed.
+    Trials and pipelines are only logged; running a pipeline takes
+    pipeline_time.
+    """
+
+    def __init__(self, startup_time=3.0, pipeline_time=0.1):
+        self.startup_time = startup_time
+        self.pipeline_time = pipeline_time
+        self._ready_at = time.monotonic() + startup_time
+        self._running = True
+        self.trial = None
+
+    def _kill_nexus(self, restart=False):
+        self._running = restart
+        self._ready_at = time.monotonic() + self.startup_time
+        self.trial = None
+
+    def viconnexus(self):
+        if not self._running or time.monotonic() < self._ready_at:
+            raise ConnectionRefusedError('cannot connect to fake Nexus')
+        return self
+
+    def GetTrialName(self):
+        self.viconnexus()
+        return ('', '') if self.trial is None else ('', self.trial)
+
+    def _close_trial(self):
+        self.viconnexus()
+        self.trial = None
+
+    def _open_trial(self, trialpath):
+        self.viconnexus()
+        self.trial = str(trialpath)
+
+    def _run_pipelines(self, pipelines):
+        self.viconnexus()
+        for pipeline in pipelines:
+            logger.debug(f'fake Nexus: running {pipeline} on {self.trial}')
+            time.sleep(self.pipeline_time)
+
@@ -7,29 +7,128 @@ Based on extractEMG.py by Ned Pires.
 
 @author: Jussi (jnu@iki.fi)
 
-requires: gaitutils, numpy, scipy
+requires: gaitutils, numpy, scipy, ezc3d (for dry runs only)
 """
 
 # %% init
 
 import os.path as op
+import time
+import functools
 import numpy as np
 import scipy
 import logging
 import openpyxl
 from openpyxl.styles import Font
 import matplotlib.pyplot as plt
+from collections import defaultdict
 
-from gaitutils import nexus, sessionutils, cfg, trial
+from gaitutils import nexus, sessionutils, cfg, trial, read_data
+
+import emgproc
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-def _compute_emg_envelope():
+@functools.lru_cache(maxsize=None)
+def _exists_mask(nframes):
+    """Return an all-True exists mask for nframes frames.
+
+    The mask is cached and shared between calls, so it must not be modified.
+    """
+    return [True] * nframes
+
+
+def _timed(timings, name, fun, *args):
+    """Call fun(*args) and record the elapsed time into timings[name]"""
+    t0 = time.perf_counter()
+    ret = fun(*args)
+    timings[name].append(time.perf_counter() - t0)
+    return ret
+
+
+def _report_timings(timings):
+    """Log time spent per call"""
+    for name, times in timings.items():
+        logger.info(
+            '%s: %d calls, %.3f s total, %.2f ms per call'
+            % (name, len(times), sum(times), 1e3 * sum(times) / len(times))
+        )
+
+
+def _write_model_outputs(vicon, subject, outputs):
+    """Write 1-D model outputs into Nexus.
+
+    outputs is a dict of output names and data. Outputs that do not yet exist
+    are created. Returns a dict of call timings.
+    """
+    timings = defaultdict(list)
+    existing = set(
+        _timed(timings, 'GetModelOutputNames', vicon.GetModelOutputNames, subject)
+    )
+    for output, data in outputs.items():
+        if output not in existing:
+            logger.debug('creating model output %s' % output)
+            _timed(
+                timings,
+                'CreateModelOutput',
+                vicon.CreateModelOutput,
+                subject,
+                output,
+                'EMG',
+                ['EMG'],
+                ['Electric Potential'],
+            )
+        logger.debug('writing data for %s' % output)
+        _timed(
+            timings,
+            'SetModelOutput',
+            vicon.SetModelOutput,
+            subject,
+            output,
+            [data],
+            _exists_mask(len(data)),
+        )
+    return timings
+
+
+def _write_model_outputs_c3d(c3dfile, outputs, framerate):
+    """Write 1-D model outputs into a new c3d file (dry run without Nexus).
+
+    The outputs are written as points, with the data in the x component.
+    Returns a dict of call timings.
+    """
+    import ezc3d
+
+    timings = defaultdict(list)
+    names = list(outputs)
+    data = np.array(list(outputs.values()))
+    t0 = time.perf_counter()
+    acq = ezc3d.c3d()
+    acq['parameters']['POINT']['RATE']['value'] = [framerate]
+    acq['parameters']['POINT']['LABELS']['value'] = tuple(names)
+    points = np.zeros((4, len(names), data.shape[1]))
+    points[0] = data
+    points[3] = 1
+    acq['data']['points'] = points
+    timings['build c3d'].append(time.perf_counter() - t0)
+    _timed(timings, 'write c3d', acq.write, str(c3dfile))
+    return timings
+
+
+def _compute_emg_envelope(source=None, dry_run_c3d=None, resample_method='auto'):
     """Compute EMG linear envelope and rectified signal for currently open Nexus trial.
 
-    Write as model outputs.
+    Write as model outputs. Returns a dict of the written data, keyed by
+    model output name.
+
+    For a dry run without Nexus, give a c3d file as source and the name of a
+    new c3d file as dry_run_c3d. The outputs are then written into that file
+    instead of Nexus.
+
+    resample_method is the method for downsampling to marker frames; see
+    emgproc.downsample().
     """
 
     # define parameters
@@ -38,13 +137,24 @@ def _compute_emg_envelope():
     BUTTER_ORDER = 4  # filter order
 
     # read EMG data
-    vicon = nexus.viconnexus()
-    emgdata = nexus._get_emg_data(vicon)['data']
-    meta = nexus._get_metadata(vicon)
+    from_c3d = source is not None
+    if source is None:
+        source = nexus.viconnexus()
+    emgdata = read_data.get_emg_data(source)['data']
+    meta = read_data.get_metadata(source)
     emgrate = meta['analograte']
-    subject = meta['name']
+    # the key is 'name' in older gaitutils versions
+    subject = meta.get('subject_name', meta.get('name'))
     nframes = meta['length']
 
+    # strip Voltage. prefix that Nexus inserts into c3d files, so that the
+    # outputs of a dry run are named as in Nexus
+    if from_c3d:
+        emgdata = {
+            (chname[8:] if chname.find('Voltage') == 0 else chname): data
+            for chname, data in emgdata.items()
+        }
+
     # apply hpf
     b_HPF, a_HPF = scipy.signal.butter(
         BUTTER_ORDER, HPF * 2 / emgrate, 'high', analog=False
@@ -67,56 +177,27 @@ def _compute_emg_envelope():
     }
 
     # downsample
+    _downsample = lambda chdata: emgproc.downsample(
+        chdata[np.newaxis, :], nframes, emgrate, meta['framerate'], resample_method
+    )[0]
     emg_rectified_ds = {
-        chname + '_Rectified': scipy.signal.resample(chdata, nframes)
+        chname + '_Rectified': _downsample(chdata)
         for chname, chdata in emg_rectified.items()
     }
     emg_linearenvelope_ds = {
-        chname + '_LinearEnvelope': scipy.signal.resample(chdata, nframes)
+        chname + '_LinearEnvelope': _downsample(chdata)
         for chname, chdata in emg_rectified_lpf.items()
     }
+    outputs = emg_rectified_ds | emg_linearenvelope_ds
 
-    # create the new model outputs in Nexus
-    existing_outputs = vicon.GetModelOutputNames(subject)
-    new_outputs = emg_rectified_ds.keys() + emg_linearenvelope_ds.keys()
-    for output in set(new_outputs) - set(existing_outputs):
-        logger.debug('creating model output %s' % output)
-        vicon.CreateModelOutput(
-            subject,
-            output,
-            'EMG',
-            {'EMG', 'EMG', 'EMG'},
-            {'Electric Potential', 'Electric Potential', 'Electric Potential'},
-        )
-
-    # write the processed EMG as model outputs
-    exists = [True] * nframes
-
-    for chname, chdata in emg_rectified_ds.items():
-        logger.debug('writing data for %s' % chname)
-        vicon.SetModelOutput(subject, chname, [chdata], exists)
-
-    for chname, chdata in emg_linearenvelope_ds.items():
-        logger.debug('writing data for %s' % chname)
-        vicon.SetModelOutput(
-            subject,
-            chname,
-            [chdata],
-            exists,
-        )
-
-    return new_outputs
-
-
-def _get_model_output(vicon, subj, var):
-    """Read a single model output from Nexus"""
-    nums, _ = vicon.GetModelOutput(subj, var)
-    if nums:
-        data = np.squeeze(np.array(nums))
+    # write all outputs in a single pass
+    if dry_run_c3d is None:
+        timings = _write_model_outputs(source, subject, outputs)
     else:
-        logger.info('cannot read model variable %s, returning nans' % var)
-        data = None
-    return data
+        timings = _write_model_outputs_c3d(dry_run_c3d, outputs, meta['framerate'])
+    _report_timings(timings)
+
+    return outputs
 
 
 def _bold_cell(ws, **cell_params):
@@ -159,21 +240,27 @@ if __name__ == '__main__':
         ncycles = dict()
         logger.debug('opening %s' % c3dfile)
         nexus._open_trial(c3dfile)
-        # compute the envelopes into Nexus model vars; names are returned
-        modelvars = _compute_emg_envelope()
+        # compute the envelopes into Nexus model vars; the data is also
+        # returned, so it does not need to be read back from Nexus
+        envelopes = _compute_emg_envelope()
+        modelvars = list(envelopes)
         tr = trial.nexus_trial()
         for ctxt in 'LR':
             this_cycles = tr.get_cycles({ctxt: 'all'})
             if ctxt not in ncycles:
                 ncycles[ctxt] = len(this_cycles)
             this_vars = [var for var in modelvars if var[0] == ctxt]
-            for var in this_vars:
-                norm_data[var] = list()
-                for cyc in this_cycles:
-                    this_data = _get_model_output(vicon, subj, var)
-                    this_data_norm = cyc.normalize(this_data)[1]
-                    norm_data[var].append(this_data_norm)
-                norm_data[var] = np.array(norm_data[var])
+            if not this_vars:
+                continue
+            this_data = np.array([envelopes[var] for var in this_vars])
+            # normalize all variables to all cycles at once: (vars x cycles x 101)
+            this_data_norm = emgproc.normalize_cycles(
+                this_data,
+                [cyc.start for cyc in this_cycles],
+                [cyc.end for cyc in this_cycles],
+            )
+            for var, var_data_norm in zip(this_vars, this_data_norm):
+                norm_data[var] = var_data_norm
         avg_data = dict()
         std_data = dict()
         for var in modelvars:
@@ -9,442 +9,258 @@ Rectify EMG from c3d files. Average and write into XLSX.
 
 # %% init
 
-import enum
+import os
 import os.path as op
-import numpy as np
-import scipy
-import logging
+import json
 import openpyxl
-from openpyxl.styles import Font
-import matplotlib.pyplot as plt
-from collections import defaultdict
-import gaitutils
+import logging
 
-from gaitutils.envutils import GaitDataError
-from gaitutils.numutils import _isint
-from gaitutils import c3d, nexus, sessionutils, cfg, trial, read_data
+import emgproc
+import emgchannels
+import stageprof
+import tablesink
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-def _bold_cell(ws, **cell_params):
-    """Write a bold-styled cell into worksheet ws"""
-    boldfont = Font(bold=True)
-    _cell = ws.cell(**cell_params)
-    _cell.font = boldfont
-
-
-def _compute_rms_envelope_c3d(c3dfile):
-    """Compute RMS-based envelope"""
-    # define parameters
-    HPF = 20  # high pass frequency
-    BUTTER_ORDER = 4  # filter order
-    RMS_WIN = 31
-
-    # read EMG data
-    emgdata = read_data.get_emg_data(c3dfile)['data']
-    meta = read_data.get_metadata(c3dfile)
-    emgrate = meta['analograte']
-    nframes = meta['length']
-
-    # strip Voltage. prefix that Nexus inserts
-    emgdata = {
-        (chname[8:] if chname.find('Voltage') == 0 else chname): data
-        for chname, data in emgdata.items()
-    }
-
-    # apply hpf
-    b_HPF, a_HPF = scipy.signal.butter(
-        BUTTER_ORDER, HPF * 2 / emgrate, 'high', analog=False
-    )
-
-    emg_hpf = {
-        chname: scipy.signal.filtfilt(b_HPF, a_HPF, chdata)
-        for chname, chdata in emgdata.items()
-    }
-
-    # RMS
-    emg_rms = {chname: gaitutils.numutils.rms(chdata, RMS_WIN) for chname, chdata in emg_hpf.items()}
-
-    # downsample
-    emg_rms_ds = {
-        chname + '_RMS': scipy.signal.resample(chdata, nframes)
-        for chname, chdata in emg_rms.items()
-    }
-
-    return emg_rms_ds
-
-
-def _compute_emg_envelope_c3d(c3dfile):
-    """Compute EMG linear envelope and rectified signal for a c3d file"""
-
-    # define parameters
-    HPF = 5  # high pass frequency
-    LPF = 10  # envelope low pass frequency
-    BUTTER_ORDER = 4  # filter order
-
-    # read EMG data
-    emgdata = read_data.get_emg_data(c3dfile)['data']
-    meta = read_data.get_metadata(c3dfile)
-    emgrate = meta['analograte']
-    nframes = meta['length']
-
-    # strip Voltage. prefix that Nexus inserts
-    emgdata = {
-        (chname[8:] if chname.find('Voltage') == 0 else chname): data
-        for chname, data in emgdata.items()
-    }
-
-    # apply hpf
-    b_HPF, a_HPF = scipy.signal.butter(
-        BUTTER_ORDER, HPF * 2 / emgrate, 'high', analog=False
-    )
-    emg_hpf = {
-        chname: scipy.signal.filtfilt(b_HPF, a_HPF, chdata)
-        for chname, chdata in emgdata.items()
-    }
-
-    # rectify
-    emg_rectified = {chname: np.abs(chdata) for chname, chdata in emg_hpf.items()}
-
-    # apply lpf
-    b_LPF, a_LPF = scipy.signal.butter(
-        BUTTER_ORDER, LPF * 2 / emgrate, 'low', analog=False
-    )
-    emg_rectified_lpf = {
-        chname: scipy.signal.filtfilt(b_LPF, a_LPF, chdata)
-        for chname, chdata in emg_rectified.items()
-    }
-
-    # downsample
-    emg_rectified_ds = {
-        chname + '_Rectified': scipy.signal.resample(chdata, nframes)
-        for chname, chdata in emg_rectified.items()
-    }
-    emg_linearenvelope_ds = {
-        chname + '_LinearEnvelope': scipy.signal.resample(chdata, nframes)
-        for chname, chdata in emg_rectified_lpf.items()
-    }
-
-    return emg_linearenvelope_ds
+# increase when the exported records change; invalidates existing outputs
+EXPORT_VERSION = 2
+# row schema for the exported curves; the XLSX sheets are a rendering of this
+RECORD_COLUMNS = ['trial', 'channel', 'context', 'curve'] + [
+    'frame %d' % k for k in range(101)
+]
 
 
-def _channel_context(chname, idx_mapper):
-    """Try to figure out channel context.
+def _trial_key(c3dfile, session_root):
+    """Identify a trial by its path relative to the session root.
 
-    idx_mapper must be a dict that maps channel index to context.
+    Trials in different subdirectories may have the same file name.
     """
-    if chname[0] in 'LR':  # Myon naming
-        return chname[0]
-    elif chname[:3] == 'EMG':  # Noraxon naming
-        dot_pos = chname.find('.')
-        idx = chname[3:dot_pos]  # channel index
-        try:
-            return idx_mapper(int(idx))
-        except ValueError:
-            raise ValueError('cannot parse channel name %s' % chname)
-    else:  # unrecognized channel
-        return None
-
-
-def _auto_adjust(ws):
-    dims = {}
-    for row in ws.rows:
-        for cell in row:
-            if cell.value:
-                dims[cell.column_letter] = max(
-                    (dims.get(cell.column_letter, 0), len(str(cell.value)))
-                )
-    for col, value in dims.items():
-        ws.column_dimensions[col].width = value
-
-
-# %% read through EMG, compute envelopes, save averaged data into XLSX
-
-# emg1-6 oikea, paitsi Vilma emg1-6 vasen
+    return op.relpath(c3dfile, session_root).replace(os.sep, '/')
 
-# Noraxon-specific mapping from ch index to context
-idx_mapper = lambda idx: 'R' if idx <= 6 else 'L'
-idx_mapper_reverse = lambda idx: 'L' if idx <= 6 else 'R'
 
-cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
+def _records(tres, kind, suffix, averaged, trialname):
+    """Yield export records for a processed trial.
 
-session_root = r'C:\Users\hus20664877\Downloads\C3D files'
-
-fname_xls = op.join(session_root, 'emg_envelopes.xlsx')
-
-norm_data = dict()
-wb = openpyxl.Workbook()
+    trialname is written into the trial column. If averaged, yield average
+    and stddev over cycles for each channel. Otherwise yield each normalized
+    cycle.
+    """
+    for chname in sorted(tres['norm'][kind]):
+        chdata = tres['norm'][kind][chname]
+        rec = [trialname, chname + suffix, tres['contexts'][chname]]
+        if averaged:
+            yield rec + ['average'] + tres['avg'][kind][chname].tolist()
+            yield rec + ['stddev'] + tres['std'][kind][chname].tolist()
+        else:
+            for curve_ind, curve in enumerate(chdata, 1):
+                yield rec + ['cycle %d' % curve_ind] + curve.tolist()
 
-# be more tolerant about toeoffs
-cfg.trial.no_toeoff = 'reject'
-cfg.trial.multiple_toeoffs = 'reject'
 
-# get the c3ds
-allfiles = list()
-for d0, dirs, files in os.walk(session_root):
-    allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
+def _sheet_rows(tres, records, averaged):
+    """Lay out trial metadata and records as worksheet rows.
 
-# compute envelopes, normalize to cycles (for matching context) and average (one per trial)
-for n, c3dfile in enumerate(sorted(allfiles)):
+    Row 5 (index 4) is the column header row.
+    """
+    rows = [
+        [],
+        ['Trial name:', op.split(tres['c3dfile'])[-1]],
+        ['N of cycles right:', tres['ncycles']['R']],
+        ['N of cycles left:', tres['ncycles']['L']],
+        [''] + RECORD_COLUMNS[4:],
+    ]
+    if not averaged:
+        rows.append([])
+    for rec in records:
+        _, chname, ctxt, curve = rec[:4]
+        if averaged:
+            label = '%s / %s' % (chname, curve)
+        else:
+            label = '%s (context=%s), %s' % (chname, ctxt, curve)
+        rows.append([label] + rec[4:])
+    return rows
+
+
+def _file_signature(fname):
+    """Return (mtime, size) of a file, for detecting changes"""
+    st = os.stat(fname)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _load_manifest(fname, settings):
+    """Load the export manifest.
+
+    Returns the per-trial entries, or an empty dict if the manifest does not
+    exist or was written with different settings.
+    """
     try:
-        lenv = _compute_emg_envelope_c3d(c3dfile)
-    except GaitDataError:
-        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
-        continue
-    tr = trial.Trial(c3dfile)
-    this_cycles = tr.get_cycles('all')
-    # count L/R cycles
-    ncycles = {
-        ctxt: len([c for c in this_cycles if c.context == ctxt]) for ctxt in 'LR'
-    }
-    # for Vilma, we have a different channel mapping
-    _idx_mapper = idx_mapper_reverse if 'VILMA' in c3dfile.upper() else idx_mapper
-    norm_data = dict()
-    chs_valid = [ch for ch in lenv if _channel_context(ch, _idx_mapper) is not None]
-    for chname in chs_valid:
-        chdata = lenv[chname]
-        ctxt_this = _channel_context(chname, idx_mapper)
-        norm_data[chname] = list()
-        for cyc in this_cycles:
-            if ctxt_this != cyc.context:
-                continue
-            chdata_norm = cyc.normalize(chdata)[1]
-            norm_data[chname].append(chdata_norm)
-        norm_data[chname] = np.array(norm_data[chname])
-
-    avg_data = dict()
-    std_data = dict()
-    for chname in chs_valid:
-        avg_data[chname] = norm_data[chname].mean(axis=0)
-        std_data[chname] = norm_data[chname].std(axis=0)
-
-    # one trial per sheet
-    ws = wb.active if n == 0 else wb.create_sheet()
-    ws.title = op.splitext(op.split(c3dfile)[-1])[0][:31]
-
-    # write some metadata
-    _bold_cell(ws, column=1, row=2, value='Trial name:')
-    _bold_cell(ws, column=1, row=3, value='N of cycles right:')
-    _bold_cell(ws, column=1, row=4, value='N of cycles left:')
-
-    ws.cell(column=2, row=2, value=op.split(c3dfile)[-1])
-    ws.cell(column=2, row=3, value=ncycles['L'])
-    ws.cell(column=2, row=4, value=ncycles['R'])
-
-    col_headers = [''] + ['frame %d' % k for k in range(101)]
-
-    for col, txt in enumerate(col_headers, 1):
-        _bold_cell(ws, column=col, row=5, value=txt)
+        with open(fname, encoding='utf-8') as fh:
+            manifest = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return dict()
+    if manifest.get('settings') != settings:
+        logger.warning('export settings have changed, rebuilding all outputs')
+        return dict()
+    return manifest['trials']
 
-    # write channel avg and std data
-    for _row, chname in enumerate(sorted(chs_valid), 3):
 
-        # average
-        _bold_cell(ws, column=1, row=_row * 2, value='%s / average' % chname)
-        for col, val in enumerate(avg_data[chname], 2):
-            ws.cell(column=col, row=_row * 2, value=val)
+def _save_manifest(fname, settings, trials):
+    """Save the export manifest"""
+    with open(fname, 'w', encoding='utf-8') as fh:
+        json.dump({'settings': settings, 'trials': trials}, fh, indent=1)
 
-        # stddev
-        _bold_cell(ws, column=1, row=_row * 2 + 1, value='%s / stddev' % chname)
-        for col, val in enumerate(std_data[chname], 2):
-            ws.cell(column=col, row=_row * 2 + 1, value=val)
 
-    _auto_adjust(ws)
+# %% read through EMG, compute envelopes, save averaged and complete (not
+# averaged) cycle data into XLSX
+if __name__ == '__main__':
 
-wb.save(filename=fname_xls)
+    # emg1-6 oikea, paitsi Vilma emg1-6 vasen
+    # (channel mapping and subject overrides are defined in emg_channels.cfg)
+    resolver = emgchannels.ChannelContextResolver()
 
+    session_root = r'C:\Users\hus20664877\Downloads\C3D files'
 
-# %% read through EMG, compute envelopes, save complete (not averaged) cycle
-# data into XLSX
-
-# emg1-6 oikea, paitsi Vilma emg1-6 vasen
-
-# Noraxon-specific mapping from ch index to context
-idx_mapper = lambda idx: 'R' if idx <= 6 else 'L'
-idx_mapper_reverse = lambda idx: 'L' if idx <= 6 else 'R'
-
-cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
-
-session_root = r'C:\Users\hus20664877\Downloads\C3D files'
-
-fname_xls = op.join(session_root, 'emg_envelopes_individual.xlsx')
-
-norm_data = dict()
-wb = openpyxl.Workbook()
-
-# be more tolerant about toeoffs
-cfg.trial.no_toeoff = 'reject'
-cfg.trial.multiple_toeoffs = 'reject'
+    # cache for computed envelopes; reruns with unchanged files and parameters
+    # will read the envelopes from here
+    cache = emgproc.EnvelopeCache(
+        op.join(op.expanduser('~'), '.emg_envelope_cache'), max_bytes=2 * 2**30
+    )
 
-# get the c3ds
-allfiles = list()
-for d0, dirs, files in os.walk(session_root):
-    allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
+    # output format: 'xlsx', 'csv' or 'parquet'
+    OUTPUT_FORMAT = 'xlsx'
+
+    # incremental mode: only process new or changed trials, and merge them into
+    # the existing outputs
+    INCREMENTAL = True
+
+    # record time and memory use per processing stage
+    PROFILE = False
+    if PROFILE:
+        stageprof.enable(memory=True)
+
+    # output files: (file basename, kind of data, channel suffix, averaged)
+    outputs = [
+        ('emg_envelopes', 'linear_envelope', '_LinearEnvelope', True),
+        ('emg_envelopes_individual', 'linear_envelope', '_LinearEnvelope', False),
+        ('emg_rms_individual', 'rms', '_RMS', False),
+    ]
+
+    cfg_overrides = {
+        'autoproc': {'nexus_forceplate_devnames': []},  # read all forceplates
+        # be more tolerant about toeoffs
+        'trial': {'no_toeoff': 'reject', 'multiple_toeoffs': 'reject'},
+    }
 
-# compute envelopes, normalize to cycles (for matching context) and average (one per trial)
-for n, c3dfile in enumerate(sorted(allfiles)):
-    try:
-        lenv = _compute_emg_envelope_c3d(c3dfile)
-    except GaitDataError:
-        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
-        continue
-    tr = trial.Trial(c3dfile)
-    this_cycles = tr.get_cycles('all')
-    # count L/R cycles
-    ncycles = {
-        ctxt: len([c for c in this_cycles if c.context == ctxt]) for ctxt in 'LR'
+    fnames = {
+        basename: op.join(session_root, '%s.%s' % (basename, OUTPUT_FORMAT))
+        for basename, *_ in outputs
     }
-    # for Vilma, we have a different channel mapping
-    _idx_mapper = idx_mapper_reverse if 'VILMA' in c3dfile.upper() else idx_mapper
-    norm_data = dict()
-    chs_valid = [ch for ch in lenv if _channel_context(ch, _idx_mapper) is not None]
-    ctxts = dict()  # context for each channel
-    for chname in chs_valid:
-        chdata = lenv[chname]
-        ctxt_this = _channel_context(chname, idx_mapper)
-        ctxts[chname] = ctxt_this
-        norm_data[chname] = list()
-        for cyc in this_cycles:
-            if ctxt_this != cyc.context:
-                continue
-            chdata_norm = cyc.normalize(chdata)[1]
-            norm_data[chname].append(chdata_norm)
-        norm_data[chname] = np.array(norm_data[chname])
-
-    avg_data = dict()
-    std_data = dict()
-    for chname in chs_valid:
-        avg_data[chname] = norm_data[chname].mean(axis=0)
-        std_data[chname] = norm_data[chname].std(axis=0)
-
-    # one trial per sheet
-    ws = wb.active if n == 0 else wb.create_sheet()
-    ws.title = op.splitext(op.split(c3dfile)[-1])[0][:31]
-
-    # write some metadata
-    _bold_cell(ws, column=1, row=2, value='Trial name:')
-    _bold_cell(ws, column=1, row=3, value='N of cycles right:')
-    _bold_cell(ws, column=1, row=4, value='N of cycles left:')
-
-    ws.cell(column=2, row=2, value=op.split(c3dfile)[-1])
-    ws.cell(column=2, row=3, value=ncycles['R'])
-    ws.cell(column=2, row=4, value=ncycles['L'])
-
-    col_headers = [''] + ['frame %d' % k for k in range(101)]
-
-    for col, txt in enumerate(col_headers, 1):
-        _bold_cell(ws, column=col, row=5, value=txt)
-
-    # loop over channels
-    row = 7
-    for ch_ind, chname in enumerate(sorted(chs_valid), 3):
-        chdata = norm_data[chname]
-        for curve_ind, curve in enumerate(chdata, 1):
-            _bold_cell(ws, column=1, row=row, value='%s (context=%s), cycle %d' % (chname, ctxts[chname], curve_ind))
-            for col, val in enumerate(curve, 2):
-                ws.cell(column=col, row=row, value=val)
-            row += 1
-
-    _auto_adjust(ws)
-
-wb.save(filename=fname_xls)
-
-
-# %% read through EMG, compute RMS envelopes, save complete (not averaged) cycle
-# data into XLSX
-
-# emg1-6 oikea, paitsi Vilma emg1-6 vasen
-
-# Noraxon-specific mapping from ch index to context
-idx_mapper = lambda idx: 'R' if idx <= 6 else 'L'
-idx_mapper_reverse = lambda idx: 'L' if idx <= 6 else 'R'
-
-cfg.autoproc.nexus_forceplate_devnames = []  # read all forceplates
-
-session_root = r'C:\Users\hus20664877\Downloads\C3D files'
-
-fname_xls = op.join(session_root, 'emg_rms_individual.xlsx')
-
-norm_data = dict()
-wb = openpyxl.Workbook()
-
-# be more tolerant about toeoffs
-cfg.trial.no_toeoff = 'reject'
-cfg.trial.multiple_toeoffs = 'reject'
-
-# get the c3ds
-allfiles = list()
-for d0, dirs, files in os.walk(session_root):
-    allfiles.extend(op.join(d0, fn) for fn in files if '.c3d' in fn.lower())
-
-# compute envelopes, normalize to cycles (for matching context) and average (one per trial)
-for n, c3dfile in enumerate(sorted(allfiles)):
-    try:
-        lenv = _compute_rms_envelope_c3d(c3dfile)
-    except GaitDataError:
-        logger.warning('cannot read EMG from %s, skipping' % c3dfile)
-        continue
-    tr = trial.Trial(c3dfile)
-    this_cycles = tr.get_cycles('all')
-    # count L/R cycles
-    ncycles = {
-        ctxt: len([c for c in this_cycles if c.context == ctxt]) for ctxt in 'LR'
+    # the manifest records which trial produced which sheet, and the state of
+    # the source file at the time
+    fname_manifest = op.join(session_root, 'emg_export_manifest.json')
+    # any change in these invalidates all existing outputs
+    settings = repr(
+        (
+            EXPORT_VERSION,
+            OUTPUT_FORMAT,
+            outputs,
+            cfg_overrides,
+            sorted(emgproc.effective_params(dict()).items()),
+            resolver.default_layout,
+            resolver.subject_layouts,
+            resolver.layouts,
+        )
+    )
+    if INCREMENTAL and all(op.isfile(fname) for fname in fnames.values()):
+        manifest = _load_manifest(fname_manifest, settings)
+    else:
+        manifest = dict()
+
+    c3dfiles = emgproc.find_c3ds(session_root)
+    unchanged = [
+        c3dfile
+        for c3dfile in c3dfiles
+        if c3dfile in manifest
+        and manifest[c3dfile]['signature'] == _file_signature(c3dfile)
+    ]
+    todo = [c3dfile for c3dfile in c3dfiles if c3dfile not in unchanged]
+    print('%d trials to process, %d unchanged' % (len(todo), len(unchanged)))
+
+    # process the trials in parallel
+    results = dict()
+    with stageprof.stage('process trials'):
+        for c3dfile, tres in emgproc.run_batch(
+            todo,
+            cfg_overrides=cfg_overrides,
+            cache=cache,
+            resolver=resolver,
+        ):
+            if tres is None:
+                logger.warning('cannot read EMG from %s, skipping' % c3dfile)
+            results[c3dfile] = tres
+
+    # entries of the new manifest; trials that could not be read are also
+    # recorded, so that they are not retried unless they change
+    trials = {
+        c3dfile: {'signature': _file_signature(c3dfile), 'sheets': dict()}
+        for c3dfile in todo
     }
-    # for Vilma, we have a different channel mapping
-    _idx_mapper = idx_mapper_reverse if 'VILMA' in c3dfile.upper() else idx_mapper
-    norm_data = dict()
-    chs_valid = [ch for ch in lenv if _channel_context(ch, _idx_mapper) is not None]
-    ctxts = dict()  # context for each channel
-    for chname in chs_valid:
-        chdata = lenv[chname]
-        ctxt_this = _channel_context(chname, idx_mapper)
-        ctxts[chname] = ctxt_this
-        norm_data[chname] = list()
-        for cyc in this_cycles:
-            if ctxt_this != cyc.context:
-                continue
-            chdata_norm = cyc.normalize(chdata)[1]
-            norm_data[chname].append(chdata_norm)
-        norm_data[chname] = np.array(norm_data[chname])
-
-    avg_data = dict()
-    std_data = dict()
-    for chname in chs_valid:
-        avg_data[chname] = norm_data[chname].mean(axis=0)
-        std_data[chname] = norm_data[chname].std(axis=0)
-
-    # one trial per sheet
-    ws = wb.active if n == 0 else wb.create_sheet()
-    ws.title = op.splitext(op.split(c3dfile)[-1])[0][:31]
-
-    # write some metadata
-    _bold_cell(ws, column=1, row=2, value='Trial name:')
-    _bold_cell(ws, column=1, row=3, value='N of cycles right:')
-    _bold_cell(ws, column=1, row=4, value='N of cycles left:')
-
-    ws.cell(column=2, row=2, value=op.split(c3dfile)[-1])
-    ws.cell(column=2, row=3, value=ncycles['R'])
-    ws.cell(column=2, row=4, value=ncycles['L'])
-
-    col_headers = [''] + ['frame %d' % k for k in range(101)]
-
-    for col, txt in enumerate(col_headers, 1):
-        _bold_cell(ws, column=col, row=5, value=txt)
-
-    # loop over channels
-    row = 7
-    for ch_ind, chname in enumerate(sorted(chs_valid), 3):
-        chdata = norm_data[chname]
-        for curve_ind, curve in enumerate(chdata, 1):
-            _bold_cell(ws, column=1, row=row, value='%s (context=%s), cycle %d' % (chname, ctxts[chname], curve_ind))
-            for col, val in enumerate(curve, 2):
-                ws.cell(column=col, row=row, value=val)
-            row += 1
-
-    _auto_adjust(ws)
-
-wb.save(filename=fname_xls)
-
-
+    trials.update({c3dfile: manifest[c3dfile] for c3dfile in unchanged})
+
+    for basename, kind, suffix, averaged in outputs:
+        with stageprof.stage('write %s' % basename):
+            fname = fnames[basename]
+            # write into a temporary file, since the old file is read at the same time
+            fname_tmp = op.join(session_root, '%s.tmp.%s' % (basename, OUTPUT_FORMAT))
+            if OUTPUT_FORMAT == 'xlsx':
+                wb_old = (
+                    openpyxl.load_workbook(fname, read_only=True) if unchanged else None
+                )
+                # one trial per sheet
+                with tablesink.XlsxWriter(fname_tmp) as writer:
+                    for c3dfile in c3dfiles:
+                        if c3dfile in unchanged:
+                            # copy the sheet from the existing output
+                            title = trials[c3dfile]['sheets'].get(basename)
+                            if title is None:
+                                continue
+                            rows = tablesink.read_sheet_rows(wb_old, title)
+                        elif (tres := results[c3dfile]) is not None:
+                            title = op.splitext(op.split(c3dfile)[-1])[0]
+                            records = _records(
+                                tres,
+                                kind,
+                                suffix,
+                                averaged,
+                                _trial_key(c3dfile, session_root),
+                            )
+                            rows = _sheet_rows(tres, records, averaged)
+                        else:
+                            continue
+                        title = writer.write_sheet(title, rows, bold_rows=[4])
+                        trials[c3dfile]['sheets'][basename] = title
+                if wb_old is not None:
+                    wb_old.close()
+            else:
+                with tablesink.open_table(fname_tmp, RECORD_COLUMNS) as table:
+                    # copy the records of unchanged trials from the existing output
+                    if unchanged:
+                        trialnames_keep = {
+                            _trial_key(c3dfile, session_root)
+                            for c3dfile in unchanged
+                        }
+                        for rec in tablesink.read_rows(fname):
+                            if rec[0] in trialnames_keep:
+                                table.append(rec)
+                    for c3dfile in todo:
+                        if (tres := results[c3dfile]) is not None:
+                            trialname = _trial_key(c3dfile, session_root)
+                            for rec in _records(
+                                tres, kind, suffix, averaged, trialname
+                            ):
+                                table.append(rec)
+            os.replace(fname_tmp, fname)
+
+    _save_manifest(fname_manifest, settings, trials)
+    stageprof.report(op.join(session_root, 'emg_export_profile.json'))
@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+"""
+running analysis engine
+
+Each c3d file is loaded once into a RunningTrial, and all registered metrics
+are computed from it. The results are combined into one table with a row per
+foot strike.
+
+metrics:
+-compression of leg during loading phase (hip joint center - ankle joint
+ center distance)
+-force at max. compression, projected to ankle-hip line
+-foot speed at n frames before foot strike
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+from time import localtime, strftime
+import time
+import itertools
+import concurrent.futures
+import numpy as np
+import glob
+import os.path as op
+import logging
+
+import gaitutils
+
+import events
+import markerstore
+import stageprof
+import tablesink
+
+logger = logging.getLogger(__name__)
+
+# how many frames before strike to include in foot speed
+FOOT_SPEED_NFRAMES = 4
+
+# registered metrics; name -> (function, marker templates, column names)
+METRICS = dict()
+
+
+def _register(name, markers, columns):
+    """Register a metric.
+
+    The metric function is called as fun(rtrial, context) and must yield
+    tuples of (strike_frame, values), where values is a dict keyed by
+    column name. Marker names are given as templates that are formatted with
+    the context, e.g. '{context}TIO'.
+    """
+
+    def _decorator(fun):
+        METRICS[name] = (fun, markers, columns)
+        return fun
+
+    return _decorator
+
+
+class ForceplateIndex:
+    """Forceplate lookup tables for a trial, indexed by marker frame.
+
+    The tables are built once, so that e.g. the force at a given frame or the
+    peak force of a forceplate stance phase are array lookups.
+
+    Parameters
+    ----------
+    trial : gaitutils.Trial
+        The trial.
+    evindex : events.EventIndex
+        The event index of the trial.
+
+    Attributes
+    ----------
+    frame_to_sample : ndarray
+        Analog sample index for each marker frame (0-based, offset removed).
+    forces : ndarray
+        Force vectors, (plates x samples x 3).
+    plate_max : ndarray
+        Maximum total force over the whole record, for each plate.
+    cycle_max : dict
+        Maximum total force during stance (strike...toeoff), keyed by
+        (context, strike frame), for the gait cycles that are on a forceplate.
+        Cycles without a toeoff are not included.
+    """
+
+    def __init__(self, trial, evindex):
+        fpdata = trial.forceplate_data
+        self.forces = np.stack([fp['F'] for fp in fpdata])
+        ftot = np.stack([fp['Ftot'] for fp in fpdata])
+        nsamples = ftot.shape[1]
+        nframes = int(np.ceil(nsamples / trial.samplesperframe))
+        self.frame_to_sample = (trial.samplesperframe * np.arange(nframes)).astype(int)
+        self.plate_max = ftot.max(axis=1)
+        self.cycle_max = dict()
+        for context in 'LR':
+            cycles = evindex.fp_cycles(context)
+            for start, toeoff, plate in zip(
+                cycles['start'], cycles['toeoff'], cycles['plate']
+            ):
+                if toeoff < 0:  # no toeoff, stance phase unknown
+                    continue
+                s0, s1 = self.frame_to_sample[[start, toeoff]]
+                self.cycle_max[(context, start)] = ftot[plate, s0:s1].max()
+
+    def force_at(self, plates, frames):
+        """Return force vectors on given plates at given marker frames.
+
+        plates and frames may be scalars or arrays of equal length.
+        """
+        return self.forces[plates, self.frame_to_sample[frames]]
+
+    def stance_max(self, context, strikes):
+        """Return the peak stance force for cycles starting at given strikes.
+
+        Gives NaN for cycles that are not in cycle_max.
+        """
+        return np.array(
+            [self.cycle_max.get((context, strike), np.nan) for strike in strikes]
+        )
+
+
+class RunningTrial:
+    """In-memory representation of a running trial shared by the metrics.
+
+    The marker data is read only once, from the marker store of the session
+    if there is one (see the markerstore module). Gait events are read from the event
+    index of the trial (see the events module), so the gaitutils Trial is only
+    loaded when the index is out of date or forceplate data is needed.
+
+    Parameters
+    ----------
+    c3dfile : str
+        The c3d file.
+    markers : list
+        Markers to read.
+    """
+
+    def __init__(self, c3dfile, markers):
+        self.c3dfile = c3dfile
+        with stageprof.stage('read markers'):
+            self.mdata = markerstore.get_marker_data(c3dfile, markers)
+        self._trial = None
+        with stageprof.stage('event index'):
+            self.events = events.load_index(c3dfile)
+            if self.events is None:
+                self.events = events.EventIndex.from_trial(self.trial)
+                events.save_index(self.events, c3dfile)
+        # foot strikes and toeoffs for each context
+        self.strikes = self.events.strikes
+        self.toeoffs = self.events.toeoffs
+        self._hip_ankle = dict()
+        self._fp_index = None
+
+    @property
+    def trial(self):
+        """The gaitutils Trial, loaded on first use"""
+        if self._trial is None:
+            with stageprof.stage('load trial'):
+                self._trial = gaitutils.Trial(self.c3dfile)
+        return self._trial
+
+    @property
+    def fp_index(self):
+        """The ForceplateIndex of the trial, built on first use"""
+        if self._fp_index is None:
+            tr = self.trial
+            with stageprof.stage('forceplate index'):
+                self._fp_index = ForceplateIndex(tr, self.events)
+        return self._fp_index
+
+    def hip_ankle(self, context):
+        """Return hip - ankle joint center vectors and their lengths.
+
+        Lengths are NaN at marker gaps. The result is computed once per context.
+        """
+        if context in self._hip_ankle:
+            return self._hip_ankle[context]
+        hip_ctr = context + 'FEP'
+        ank_ctr = context + 'TIO'
+        jnt_vec = self.mdata[hip_ctr + '_P'] - self.mdata[ank_ctr + '_P']
+        dist = np.sqrt(np.sum(jnt_vec**2, 1))
+        dist[self.mdata[hip_ctr + '_gaps']] = np.nan  # avoid zero location at gaps
+        dist[self.mdata[ank_ctr + '_gaps']] = np.nan
+        self._hip_ankle[context] = jnt_vec, dist
+        return jnt_vec, dist
+
+
+def _rowdot(a, b):
+    """Row-wise dot products of (n x 3) arrays.
+
+    Batched matmul gives the same results as np.dot() on the rows, to the last
+    bit (einsum does not).
+    """
+    return (a[:, None, :] @ b[:, :, None])[:, 0, 0]
+
+
+def _stance_windows(starts, ends, nframes):
+    """Padded (cycles x max_stance_frames) frame indices for stance phases.
+
+    Returns the indices, clipped to the data, and a mask of valid frames.
+    Like slicing, windows are truncated at the end of data.
+    """
+    starts = np.asarray(starts, dtype=int)
+    ends = np.minimum(np.asarray(ends, dtype=int), nframes)
+    lens = ends - starts
+    if np.any(lens <= 0):
+        raise ValueError('empty stance phase')
+    offsets = np.arange(lens.max())
+    idx = starts[:, None] + offsets
+    valid = offsets < lens[:, None]
+    return np.minimum(idx, nframes - 1), valid
+
+
+def compressions(dist, strikes, toeoffs):
+    """Leg compression during stance phases.
+
+    Compression is the hip-ankle distance at strike minus its minimum during
+    the stance phase (strike...toeoff).
+    """
+    if len(strikes) == 0:
+        return np.array([])
+    idx, valid = _stance_windows(strikes, toeoffs, len(dist))
+    # pad with inf so that padding never wins; NaNs (gaps) propagate
+    min_lens = np.where(valid, dist[idx], np.inf).min(axis=1)
+    return dist[strikes] - min_lens
+
+
+@_register(
+    'compression',
+    ['{context}FEP', '{context}TIO'],
+    ['toeoff frame', 'compression (mm)'],
+)
+def _compression(rtr, context):
+    """Compression of leg during loading phase, for all strikes"""
+    _, dist = rtr.hip_ankle(context)
+    strikes, toeoffs = rtr.events.paired(context)
+    comps = compressions(dist, strikes, toeoffs)
+    for strike, toeoff, comp in zip(strikes, toeoffs, comps):
+        yield strike, {'toeoff frame': toeoff, 'compression (mm)': comp}
+
+
+@_register(
+    'force_at_compression',
+    ['{context}FEP', '{context}TIO'],
+    [
+        'gait cycle',
+        'frame of max compression',
+        'max. compression (mm)',
+        'forceplate id',
+        'maximum contact force (N)',
+        'peak force in stance (N)',
+        'force at max. compression (N)',
+        'ankle-hip projected force at max. compression (N)',
+        'ankle-hip projected Fx at max. compression (N)',
+        'ankle-hip projected Fy at max. compression (N)',
+        'ankle-hip projected Fz at max. compression (N)',
+    ],
+)
+def _force_at_compression(rtr, context):
+    """Force at max. compression for forceplate cycles.
+
+    All cycles are processed at once, using padded stance windows.
+    """
+    jnt_vec, dist = rtr.hip_ankle(context)
+    fp_cycles = rtr.events.fp_cycles(context)
+    strikes = fp_cycles['start']
+    if len(strikes) == 0:
+        return
+
+    fpi = rtr.fp_index
+    toeoffs = fp_cycles['toeoff']
+    plates = fp_cycles['plate']
+    idx, valid = _stance_windows(strikes, toeoffs, len(dist))
+    # pad with inf so that padding never wins; NaNs (gaps) propagate to the
+    # minimum and argmin like they do for slices
+    dist_win = np.where(valid, dist[idx], np.inf)
+    # minimum length during contact phase
+    min_lens = dist_win.min(axis=1)
+    # frame where min. length (max compression) occurs
+    min_frames = idx[np.arange(len(strikes)), np.argmin(dist_win, axis=1)]
+    jnt_vecs_at_min = jnt_vec[min_frames, :]
+    jnt_vecs_at_min_1 = (
+        jnt_vecs_at_min / np.sqrt(_rowdot(jnt_vecs_at_min, jnt_vecs_at_min))[:, None]
+    )
+    fvecs_at_min_comp = -fpi.force_at(plates, min_frames)
+    # projection
+    fprojs = (
+        jnt_vecs_at_min_1 * _rowdot(jnt_vecs_at_min_1, fvecs_at_min_comp)[:, None]
+    )
+    comps = dist[strikes] - min_lens
+    fnorms = np.sqrt(_rowdot(fvecs_at_min_comp, fvecs_at_min_comp))
+    fproj_norms = np.sqrt(_rowdot(fprojs, fprojs))
+    stance_maxs = fpi.stance_max(context, strikes)
+
+    for k, cycle_index in enumerate(fp_cycles['index']):
+        fx, fy, fz = fprojs[k]
+        yield strikes[k], {
+            'gait cycle': context + str(cycle_index),
+            'frame of max compression': min_frames[k],
+            'max. compression (mm)': comps[k],
+            'forceplate id': plates[k],
+            'maximum contact force (N)': fpi.plate_max[plates[k]],
+            'peak force in stance (N)': stance_maxs[k],
+            'force at max. compression (N)': fnorms[k],
+            'ankle-hip projected force at max. compression (N)': fproj_norms[k],
+            'ankle-hip projected Fx at max. compression (N)': fx,
+            'ankle-hip projected Fy at max. compression (N)': fy,
+            'ankle-hip projected Fz at max. compression (N)': fz,
+        }
+
+
+def format_markers(templates, contexts):
+    """Format marker name templates for the given contexts, without duplicates"""
+    markers = list()
+    for template in templates:
+        for context in contexts:
+            if (marker := template.format(context=context)) not in markers:
+                markers.append(marker)
+    return markers
+
+
+def strike_window_columns(nframes=FOOT_SPEED_NFRAMES, step=1):
+    """Return the column names of the strike_windows() table"""
+    offsets = step * np.arange(nframes, 0, -1)
+    return ['filename', 'context', 'strike frame', 'marker'] + [
+        'foot speed %g frames before strike (m/s)' % offset for offset in offsets
+    ]
+
+
+def strike_windows(
+    rtr, markers, contexts='LR', nframes=FOOT_SPEED_NFRAMES, step=1, strikes=None
+):
+    """Extract marker speed windows before foot strikes.
+
+    The speed (absolute vertical velocity) is taken at times strike - k * step
+    for k = nframes...1. Times that fall between frames are linearly
+    interpolated, so sub-frame resolution can be obtained by a non-integer
+    step or by fractional strike times. Times outside the data and marker
+    gaps give NaN.
+
+    Parameters
+    ----------
+    rtr : RunningTrial
+        The trial. It must contain the markers.
+    markers : list
+        Marker names or templates, e.g. '{context}TIO'.
+    contexts : str, optional
+        Contexts to process.
+    nframes : int, optional
+        Number of samples in the window.
+    step : float, optional
+        Spacing of the samples in frames.
+    strikes : dict, optional
+        Strike times (frames, possibly fractional) for each context. Default
+        is the foot strikes of the trial.
+
+    Returns
+    -------
+    dict
+        Table columns (see strike_window_columns()) as arrays; one row per
+        strike and marker.
+    """
+    vel_conv = rtr.events.framerate / 1.0e3  # mm/frame -> m/s
+    offsets = step * np.arange(nframes, 0, -1)
+    ctxts, strike_frames, marker_names, windows = [], [], [], []
+    for context in contexts:
+        ctx_strikes = np.asarray(
+            rtr.strikes[context] if strikes is None else strikes[context]
+        )
+        ctx_markers = [template.format(context=context) for template in markers]
+        # markers x frames
+        vel = np.abs(np.stack([rtr.mdata[m + '_V'][:, 2] for m in ctx_markers]))
+        for k, marker in enumerate(ctx_markers):
+            vel[k, rtr.mdata[marker + '_gaps']] = np.nan
+        nf = vel.shape[1]
+        times = ctx_strikes[:, None] - offsets  # strikes x window
+        idx = np.floor(times).astype(int)
+        frac = times - idx
+        valid = (idx >= 0) & (idx < nf) & ((frac == 0) | (idx + 1 < nf))
+        idx = np.clip(idx, 0, nf - 1)
+        win = vel[:, idx]  # markers x strikes x window
+        if np.any(frac):
+            win_next = vel[:, np.minimum(idx + 1, nf - 1)]
+            win = np.where(frac > 0, win + frac * (win_next - win), win)
+        win = vel_conv * np.where(valid, win, np.nan)
+        # one row per strike and marker
+        nstrikes, nmarkers = len(ctx_strikes), len(ctx_markers)
+        windows.append(win.transpose(1, 0, 2).reshape(nstrikes * nmarkers, nframes))
+        ctxts.append(np.full(nstrikes * nmarkers, context))
+        strike_frames.append(np.repeat(ctx_strikes, nmarkers))
+        marker_names.append(np.tile(ctx_markers, nstrikes))
+
+    columns = strike_window_columns(nframes, step)
+    windows = np.concatenate(windows)
+    table = {
+        'filename': np.full(len(windows), rtr.c3dfile),
+        'context': np.concatenate(ctxts),
+        'strike frame': np.concatenate(strike_frames),
+        'marker': np.concatenate(marker_names),
+    }
+    table.update(zip(columns[4:], windows.T))
+    return table
+
+
+@_register(
+    'foot_speed',
+    ['{context}TIO'],
+    strike_window_columns()[4:],
+)
+def _foot_speed(rtr, context):
+    """Foot speed at FOOT_SPEED_NFRAMES frames before each foot strike"""
+    table = strike_windows(rtr, ['{context}TIO'], context)
+    columns = METRICS['foot_speed'][2]
+    for k, strike in enumerate(table['strike frame']):
+        yield strike, {col: table[col][k] for col in columns}
+
+
+def strike_window_rows(
+    c3dfile, markers, contexts='LR', nframes=FOOT_SPEED_NFRAMES, step=1
+):
+    """Return strike window rows for a c3d file.
+
+    The rows follow result_columns(strike_window_columns(nframes, step)).
+    This is a module-level function, so it can be run in worker processes by
+    run_batch().
+    """
+    rtr = RunningTrial(c3dfile, format_markers(markers, contexts))
+    table = strike_windows(rtr, markers, contexts, nframes, step)
+    rows = zip(*(col.tolist() for col in table.values()))
+    return [list(row) + [None] for row in rows]
+
+
+def force_at_compression_columns():
+    """Return the column names of the force_at_compression_rows() table"""
+    return result_columns(['filename'] + METRICS['force_at_compression'][2])
+
+
+def force_at_compression_rows(c3dfile, context):
+    """Return force at max. compression rows for a c3d file.
+
+    One row per forceplate cycle of the given context; the rows follow
+    force_at_compression_columns(). This is a module-level function, so it
+    can be run in worker processes by run_batch().
+    """
+    rtr = load_trial(c3dfile, ['force_at_compression'], context)
+    columns = METRICS['force_at_compression'][2]
+    with stageprof.stage('metric force_at_compression'):
+        values = list(_force_at_compression(rtr, context))
+    return [[c3dfile] + [vals[col] for col in columns] + [None] for _, vals in values]
+
+
+def result_columns(columns):
+    """Add the error column to result table columns"""
+    # for files that could not be processed
+    return columns + ['error']
+
+
+def error_row(c3dfile, columns, error):
+    """Return the row for a file that could not be processed"""
+    return [c3dfile] + [None] * (len(columns) - 2) + [error]
+
+
+def _markers_for(metrics, contexts):
+    """Return the markers needed for the given metrics and contexts"""
+    return format_markers(
+        [template for name in metrics for template in METRICS[name][1]], contexts
+    )
+
+
+def load_trial(c3dfile, metrics=None, contexts='LR'):
+    """Load a c3d file for computing the given metrics (default all)"""
+    metrics = list(METRICS) if metrics is None else metrics
+    return RunningTrial(c3dfile, _markers_for(metrics, contexts))
+
+
+def table_columns(metrics=None):
+    """Return the column names of the combined table"""
+    metrics = list(METRICS) if metrics is None else metrics
+    columns = ['filename', 'context', 'strike frame']
+    for name in metrics:
+        columns.extend(col for col in METRICS[name][2] if col not in columns)
+    return result_columns(columns)
+
+
+def compute_metrics(c3dfile, metrics=None, contexts='LR'):
+    """Compute metrics (default all) for a c3d file.
+
+    Returns a list of rows of the combined table (see table_columns()); one
+    row per foot strike. Metrics that do not apply to a strike leave their
+    columns empty (None).
+    """
+    metrics = list(METRICS) if metrics is None else metrics
+    rtr = load_trial(c3dfile, metrics, contexts)
+    columns = table_columns(metrics)
+    rows = list()
+    for context in contexts:
+        values = dict()  # strike frame -> values
+        for name in metrics:
+            fun = METRICS[name][0]
+            with stageprof.stage('metric ' + name):
+                for strike, vals in fun(rtr, context):
+                    values.setdefault(strike, dict()).update(vals)
+        for strike in sorted(values):
+            vals = values[strike]
+            vals.update({'filename': c3dfile, 'context': context, 'strike frame': strike})
+            rows.append([vals.get(col) for col in columns])
+    return rows
+
+
+def _run_one(fun, c3dfile):
+    """Call fun(c3dfile) in a worker and catch any errors.
+
+    Returns a tuple of (rows, error, profiling stats).
+    """
+    try:
+        rows, error = list(fun(c3dfile)), None
+    except Exception as e:
+        rows, error = None, '%s: %s' % (type(e).__name__, e)
+    return rows, error, stageprof.pop_stats() if stageprof.enabled else None
+
+
+def run_batch(c3dfiles, fun=compute_metrics, max_workers=None):
+    """Compute per-file results in a process pool.
+
+    Parameters
+    ----------
+    c3dfiles : list
+        The c3d files to process.
+    fun : function, optional
+        Function that is called as fun(c3dfile) and returns an iterable of
+        result rows. It must be picklable, i.e. a module-level function or a
+        functools.partial of one. Default is compute_metrics() with all
+        metrics.
+    max_workers : int, optional
+        Number of worker processes. Default is the number of CPUs.
+
+    Yields
+    ------
+    tuple
+        (c3dfile, rows, error) in the order of c3dfiles. If processing a file
+        failed, rows is None and error is the error message; otherwise error
+        is None.
+    """
+    t0 = time.perf_counter()
+    nfiles = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_run_one, itertools.repeat(fun), c3dfiles)
+        for c3dfile, (rows, error, stats) in zip(c3dfiles, results):
+            nfiles += 1
+            if stats:
+                stageprof.merge_stats(stats)
+            if error is not None:
+                logger.warning('could not process %s: %s' % (c3dfile, error))
+            yield c3dfile, rows, error
+    elapsed = time.perf_counter() - t0
+    logger.info(
+        'processed %d files in %.1f s (%.2f files/s)'
+        % (nfiles, elapsed, nfiles / elapsed if elapsed else 0)
+    )
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    # name files according to script start time
+    timestr_ = strftime("%Y_%m_%d-%H%M%S", localtime())
+    rootdir = u'Z:/siirto/Running/'
+    # 'xlsx', 'csv' or 'parquet'
+    OUTPUT_FORMAT = 'xlsx'
+    outfile = op.join(rootdir, 'running_metrics_%s.%s' % (timestr_, OUTPUT_FORMAT))
+    files = glob.glob(op.join(rootdir, '*.c3d'))
+    # number of worker processes; None for all CPUs
+    MAX_WORKERS = None
+
+    columns = table_columns()
+    types = {'filename': str, 'context': str, 'gait cycle': str, 'error': str}
+    with tablesink.open_table(outfile, columns, types=types) as table:
+        for c3dfile, file_rows, error in run_batch(files, max_workers=MAX_WORKERS):
+            if error is None:
+                for row in file_rows:
+                    table.append(row)
+            else:
+                table.append(error_row(c3dfile, columns, error))
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Session scheduler for processing several sessions concurrently.
+
+The processing of each session is a chain of steps, run in order. The chains
+of different sessions run concurrently in a thread pool, so that e.g. one
+session can be tagged and reported while the next one is being processed in
+Nexus. Steps that use Nexus are marked with nexus=True; these are serialized
+behind a single lock, since there is only one Nexus instance.
+
+Progress is printed as the steps finish, and the time of each step is
+recorded for each session (see SessionScheduler.summary()). The steps are
+also recorded as stageprof stages.
+
+Example:
+
+    sched = SessionScheduler()
+    sched.run(
+        session_dirs,
+        [
+            Step('autoproc', _autoproc, nexus=True),
+            Step('autotag', _autotag),
+        ],
+    )
+    print(sched.summary())
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import time
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import stageprof
+
+logger = logging.getLogger(__name__)
+
+# a processing step: fun(sessiondir) is called for each session
+Step = namedtuple('Step', ['name', 'fun', 'nexus'], defaults=[False])
+
+# the lock that serializes all Nexus-bound steps
+nexus_lock = threading.Lock()
+
+
+class SessionScheduler:
+    """Run chains of processing steps for several sessions.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of sessions processed at once. Default is the
+        ThreadPoolExecutor default.
+
+    Attributes
+    ----------
+    timings : dict
+        Time (s) of each finished step, keyed by (session name, step name).
+    results : dict
+        Return value of each finished step, keyed as timings.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.timings = dict()
+        self.results = dict()
+        self._lock = threading.Lock()
+        self._nsteps = self._ndone = 0
+
+    def _progress(self, sessiondir, step, elapsed):
+        with self._lock:
+            self._ndone += 1
+            self.timings[sessiondir.name, step.name] = elapsed
+            print(
+                f'[{self._ndone}/{self._nsteps}] {sessiondir.name}: '
+                f'{step.name} done in {elapsed:.1f} s'
+            )
+
+    def _run_session(self, sessiondir, steps):
+        """Run the steps of one session in order"""
+        for step in steps:
+            t0 = time.perf_counter()
+            if step.nexus:
+                with nexus_lock:
+                    # exclude the wait for the lock from the stage time
+                    t0 = time.perf_counter()
+                    with stageprof.stage(step.name):
+                        res = step.fun(sessiondir)
+            else:
+                with stageprof.stage(step.name):
+                    res = step.fun(sessiondir)
+            self.results[sessiondir.name, step.name] = res
+            self._progress(sessiondir, step, time.perf_counter() - t0)
+
+    def run(self, session_dirs, steps):
+        """Run the steps for each session.
+
+        Steps of a session run in order; a failed step skips the remaining
+        steps of that session, while the other sessions continue. Raises
+        RuntimeError after all sessions have finished, if any step failed.
+
+        Parameters
+        ----------
+        session_dirs : list
+            Session directories (Path).
+        steps : list
+            Step instances.
+        """
+        with self._lock:
+            self._nsteps += len(session_dirs) * len(steps)
+        errors = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._run_session, sessiondir, steps): sessiondir
+                for sessiondir in session_dirs
+            }
+            for future in as_completed(futures):
+                sessiondir = futures[future]
+                if (e := future.exception()) is not None:
+                    logger.error(f'{sessiondir.name} failed: {e!r}')
+                    errors[sessiondir] = e
+        if errors:
+            raise RuntimeError(
+                f'processing failed for sessions: {[s.name for s in errors]}'
+            ) from next(iter(errors.values()))
+
+    def summary(self):
+        """Return the step timings as a text table (sessions x steps)"""
+        sessions = list(dict.fromkeys(session for session, _ in self.timings))
+        steps = list(dict.fromkeys(step for _, step in self.timings))
+        width = max([len('session')] + [len(s) for s in sessions])
+        lines = [
+            f'{"session":<{width}} '
+            + ' '.join(f'{step:>{max(len(step), 8)}}' for step in steps)
+        ]
+        for session in sessions:
+            cols = list()
+            for step in steps:
+                elapsed = self.timings.get((session, step))
+                txt = '-' if elapsed is None else f'{elapsed:.1f}'
+                cols.append(f'{txt:>{max(len(step), 8)}}')
+            lines.append(f'{session:<{width}} ' + ' '.join(cols))
+        return '\n'.join(lines)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight per-stage profiling for the batch scripts.
+
+Named stages are timed with the stage() context manager or the profiled()
+decorator. For each stage, the number of calls, the total wall time and
+optionally the peak memory use (as traced by tracemalloc) are recorded.
+Nested stages are recorded separately, and a stage includes the time of its
+substages.
+
+Profiling is disabled by default; a disabled stage() or profiled() costs only
+an attribute check. Call enable() in the main script to turn it on. The
+setting is passed to worker processes that are started afterwards via an
+environment variable, and the batch runners merge the stats of their workers
+(see pop_stats() and merge_stats()). At the end, report() prints a text table
+and optionally writes the stats as JSON.
+
+Stages may be recorded from several threads. The memory traced by
+tracemalloc is process-wide, however, so the peak memory of a stage that
+overlaps with a stage of another thread cannot be attributed to it. Such
+calls are not included in the peak memory of the stage; a stage whose calls
+all overlapped has no peak memory ('-' in the summary, null in JSON).
+
+Example:
+
+    import stageprof
+
+    stageprof.enable()
+    with stageprof.stage('read'):
+        ...
+
+    @stageprof.profiled('compute')
+    def compute(...):
+        ...
+
+    stageprof.report('profile.json')
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# environment variable that carries the setting to worker processes; values
+# are '1' (timing) and '2' (timing and memory)
+ENV_VAR = 'GAIT_STAGEPROF'
+
+_stats = dict()  # stage name -> {'calls', 'time', 'peak_mem'}
+# thread id -> [start memory, peak so far, concurrent] for active stages
+_mem_stacks = dict()
+_stats_lock = threading.Lock()
+_mem_lock = threading.Lock()
+_null = nullcontext()
+enabled = False
+trace_memory = False
+
+
+def enable(memory=False):
+    """Enable profiling in this process and in subsequently started workers.
+
+    If memory is True, peak memory is also recorded. Memory tracing slows
+    down the code considerably, so timings are less accurate with it.
+    """
+    global enabled, trace_memory
+    enabled = True
+    trace_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    os.environ[ENV_VAR] = '2' if memory else '1'
+
+
+def disable():
+    """Disable profiling"""
+    global enabled, trace_memory
+    enabled = trace_memory = False
+    os.environ.pop(ENV_VAR, None)
+
+
+def _max_mem(a, b):
+    """Max. of peak memory values, which may be None (not available)"""
+    return b if a is None else a if b is None else max(a, b)
+
+
+def _record(name, elapsed, peak_mem):
+    with _stats_lock:
+        st = _stats.setdefault(name, {'calls': 0, 'time': 0.0, 'peak_mem': None})
+        st['calls'] += 1
+        st['time'] += elapsed
+        st['peak_mem'] = _max_mem(st['peak_mem'], peak_mem)
+
+
+def _mem_enter():
+    """Start tracking the peak memory of a stage in the current thread"""
+    with _mem_lock:
+        current, peak = tracemalloc.get_traced_memory()
+        stack = _mem_stacks.setdefault(threading.get_ident(), list())
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        # while stages of several threads are active, the peak memory cannot
+        # be attributed to any of them
+        concurrent = len(_mem_stacks) > 1
+        if concurrent:
+            for entries in _mem_stacks.values():
+                for entry in entries:
+                    entry[2] = True
+        tracemalloc.reset_peak()
+        stack.append([current, current, concurrent])
+
+
+def _mem_exit():
+    """Return the peak memory of the ending stage, or None if not available"""
+    with _mem_lock:
+        tid = threading.get_ident()
+        if not (stack := _mem_stacks.get(tid)):
+            return None
+        start, peak_so_far, concurrent = stack.pop()
+        peak = max(peak_so_far, tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        else:
+            del _mem_stacks[tid]
+        return None if concurrent else peak - start
+
+
+@contextmanager
+def _stage(name):
+    if trace_memory:
+        _mem_enter()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        peak_mem = _mem_exit() if trace_memory else 0
+        _record(name, elapsed, peak_mem)
+
+
+def stage(name):
+    """Context manager that records a named stage"""
+    return _stage(name) if enabled else _null
+
+
+def profiled(name=None):
+    """Decorator that records each call of a function as a stage.
+
+    The stage name defaults to the function name.
+    """
+
+    def _decorator(fun):
+        stage_name = name or fun.__name__
+
+        @functools.wraps(fun)
+        def _wrapper(*args, **kwargs):
+            if not enabled:
+                return fun(*args, **kwargs)
+            with _stage(stage_name):
+                return fun(*args, **kwargs)
+
+        return _wrapper
+
+    return _decorator
+
+
+def pop_stats():
+    """Return the recorded stats and clear them"""
+    with _stats_lock:
+        stats = {name: dict(st) for name, st in _stats.items()}
+        _stats.clear()
+    return stats
+
+
+def merge_stats(stats):
+    """Merge stats (e.g. from a worker process) into the recorded stats"""
+    with _stats_lock:
+        for name, other in stats.items():
+            st = _stats.setdefault(
+                name, {'calls': 0, 'time': 0.0, 'peak_mem': None}
+            )
+            st['calls'] += other['calls']
+            st['time'] += other['time']
+            st['peak_mem'] = _max_mem(st['peak_mem'], other['peak_mem'])
+
+
+def summary():
+    """Return the recorded stats as a text table, slowest stages first"""
+    lines = [
+        '%-40s %8s %12s %12s %12s'
+        % ('stage', 'calls', 'total (s)', 'per call (ms)', 'peak (MB)')
+    ]
+    for name, st in sorted(_stats.items(), key=lambda item: -item[1]['time']):
+        peak_mem = st['peak_mem']
+        lines.append(
+            '%-40s %8d %12.3f %12.2f %12s'
+            % (
+                name,
+                st['calls'],
+                st['time'],
+                1e3 * st['time'] / st['calls'],
+                '-' if peak_mem is None else '%.1f' % (peak_mem / 2**20),
+            )
+        )
+    return '\n'.join(lines)
+
+
+def report(fname_json=None):
+    """Print the summary table, and write the stats as JSON if requested"""
+    if not _stats:
+        return
+    print(summary())
+    if fname_json is not None:
+        with open(fname_json, 'w', encoding='utf-8') as fh:
+            json.dump(
+                {'trace_memory': trace_memory, 'stages': _stats}, fh, indent=1
+            )
+
+
+def _clear_in_child():
+    """Forget stats inherited from the parent, which reports them itself"""
+    global _stats_lock, _mem_lock
+    _stats_lock = threading.Lock()
+    _mem_lock = threading.Lock()
+    _stats.clear()
+    _mem_stacks.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_clear_in_child)
+
+# workers inherit the setting of the parent process
+if os.environ.get(ENV_VAR):
+    enable(memory=os.environ[ENV_VAR] == '2')
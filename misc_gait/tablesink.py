@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming table writers for XLSX, CSV and Parquet output.
+
+Rows are written as they are produced, so memory use does not grow with the
+size of the output. XLSX output uses the openpyxl write-only mode. Workbooks
+are written either one sheet at a time (XlsxWriter; column widths are computed
+from the data of each sheet before it is written) or as a single table that
+rows are appended to (XlsxTableWriter). Values keep their types, so numbers
+stay numeric in all formats. Parquet output requires pyarrow.
+
+@author: Jussi (jnu@iki.fi)
+
+requires: openpyxl, pyarrow (for Parquet only)
+"""
+
+import csv
+import math
+import os.path as op
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+
+def _col_widths(rows):
+    """Compute column widths (in characters) from rows of data"""
+    widths = dict()
+    for row in rows:
+        for col, val in enumerate(row, 1):
+            if val:
+                widths[col] = max(widths.get(col, 0), len(str(val)))
+    return widths
+
+
+class XlsxWriter:
+    """Write-only XLSX workbook that is written one sheet at a time.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .xlsx file to create.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._wb = openpyxl.Workbook(write_only=True)
+        self._boldfont = Font(bold=True)
+
+    def write_sheet(self, title, rows, bold_rows=(), bold_first_col=True):
+        """Write a worksheet.
+
+        Parameters
+        ----------
+        title : str
+            Sheet title. Truncated to 31 characters (the Excel limit).
+        rows : list
+            List of rows; each row is a list of values. Empty lists produce
+            empty rows.
+        bold_rows : iterable, optional
+            Indices (0-based) of rows whose cells are written in bold.
+        bold_first_col : bool, optional
+            Write the first column (row labels) in bold.
+
+        Returns
+        -------
+        str
+            The actual sheet title. It differs from title if the title was
+            truncated, or if openpyxl had to make it unique.
+        """
+        ws = self._wb.create_sheet(title=title[:31])
+        # widths must be set before the first row is written
+        for col, width in _col_widths(rows).items():
+            ws.column_dimensions[get_column_letter(col)].width = width
+        bold_rows = set(bold_rows)
+        for k, row in enumerate(rows):
+            # plain values are much cheaper to write than styled cells
+            if k in bold_rows:
+                row = [self._bold(ws, val) for val in row]
+            elif bold_first_col and row:
+                row = [self._bold(ws, row[0])] + list(row[1:])
+            ws.append(row)
+        return ws.title
+
+    def _bold(self, ws, val):
+        """Make a bold-styled write-only cell"""
+        cell = WriteOnlyCell(ws, value=val)
+        cell.font = self._boldfont
+        return cell
+
+    def close(self):
+        """Save the workbook"""
+        self._wb.save(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class XlsxTableWriter:
+    """Streaming XLSX table writer.
+
+    The table is written into a single sheet with a bold header row. Since
+    rows are not known in advance, column widths are set from the column
+    names. NaN values are written as empty cells.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .xlsx file to create.
+    columns : list
+        Column names, written as the header row.
+    title : str, optional
+        Sheet title.
+    """
+
+    def __init__(self, filename, columns, title='Results'):
+        self.filename = filename
+        self.columns = list(columns)
+        self._writer = XlsxWriter(filename)
+        self._ws = self._writer._wb.create_sheet(title=title[:31])
+        for col, width in _col_widths([self.columns]).items():
+            self._ws.column_dimensions[get_column_letter(col)].width = width
+        self._ws.append([self._writer._bold(self._ws, val) for val in self.columns])
+
+    def append(self, row):
+        """Write a single row"""
+        self._ws.append(
+            [None if isinstance(val, float) and math.isnan(val) else val for val in row]
+        )
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CsvWriter:
+    """Streaming CSV table writer.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .csv file to create.
+    columns : list
+        Column names, written as the header row.
+    """
+
+    def __init__(self, filename, columns):
+        self.filename = filename
+        self.columns = list(columns)
+        self._fh = open(filename, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._fh)
+        self._writer.writerow(self.columns)
+
+    def append(self, row):
+        """Write a single row"""
+        self._writer.writerow(row)
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParquetWriter:
+    """Streaming Parquet table writer.
+
+    Rows are buffered and written as row groups of batch_rows rows. Column
+    types that are not given are inferred from the first row group; columns
+    that have no values in it are stored as floats.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .parquet file to create.
+    columns : list
+        Column names.
+    types : dict, optional
+        Python types (float, int, str or bool) of columns, keyed by column
+        name. Give at least text columns that may be empty at the start.
+    batch_rows : int, optional
+        Number of rows per row group.
+    """
+
+    def __init__(self, filename, columns, types=None, batch_rows=1000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('Parquet output requires the pyarrow package')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.filename = filename
+        self.columns = list(columns)
+        self.types = types or dict()
+        self.batch_rows = batch_rows
+        self._rows = list()
+        self._writer = None
+
+    def append(self, row):
+        """Write a single row"""
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        coldata = [list(col) for col in zip(*self._rows)]
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(self.filename, self._schema(coldata))
+        table = self._pa.table(
+            dict(zip(self.columns, coldata)), schema=self._writer.schema
+        )
+        self._writer.write_table(table)
+        self._rows = list()
+
+    def _schema(self, coldata):
+        """Build the file schema from the given types and the first row group"""
+        pa = self._pa
+        pa_types = {float: pa.float64(), int: pa.int64(), str: pa.string(), bool: pa.bool_()}
+        fields = list()
+        for name, vals in zip(self.columns, coldata):
+            if name in self.types:
+                type_ = pa_types[self.types[name]]
+            else:
+                type_ = pa.array(vals).type
+                if pa.types.is_null(type_):
+                    type_ = pa.float64()
+            fields.append(pa.field(name, type_))
+        return pa.schema(fields)
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_sheet_rows(wb, title):
+    """Read the rows of a sheet in a (read-only) workbook as lists"""
+    return [list(row) for row in wb[title].iter_rows(values_only=True)]
+
+
+def read_rows(filename):
+    """Yield the data rows of a table written by CsvWriter or ParquetWriter.
+
+    CSV values are returned as strings.
+    """
+    ext = op.splitext(filename)[1].lower()
+    if ext == '.csv':
+        with open(filename, newline='', encoding='utf-8') as fh:
+            reader = csv.reader(fh)
+            next(reader)  # skip header
+            yield from reader
+    elif ext == '.parquet':
+        import pyarrow.parquet
+
+        pfile = pyarrow.parquet.ParquetFile(filename)
+        for batch in pfile.iter_batches():
+            yield from (list(row.values()) for row in batch.to_pylist())
+    else:
+        raise ValueError('unsupported table format: %s' % ext)
+
+
+def open_table(filename, columns, types=None):
+    """Open a streaming table writer according to the filename extension.
+
+    Supported extensions are .xlsx, .csv and .parquet. types (see
+    ParquetWriter) is only needed for Parquet.
+    """
+    ext = op.splitext(filename)[1].lower()
+    if ext == '.xlsx':
+        return XlsxTableWriter(filename, columns)
+    elif ext == '.csv':
+        return CsvWriter(filename, columns)
+    elif ext == '.parquet':
+        return ParquetWriter(filename, columns, types=types)
+    else:
+        raise ValueError('unsupported table format: %s' % ext)
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+pytest configuration for the misc_gait tests.
+
+The modules under test are imported as top-level modules, as the scripts do.
+"""
+
+import sys
+import os.path as op
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of strike/toeoff pairing and leg compression on synthetic data.
+
+events.pair_strikes() and running.compressions() are checked against the
+per-strike loops they replaced, and timed together with the loops. Run with
+
+    pytest tests/test_bench_running.py --benchmark-group-by=group
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import numpy as np
+import pytest
+
+import events
+import running
+
+# synthetic treadmill trial: duration (s), frame rate and stride length
+DURATION = 600
+FRAMERATE = 200
+STRIDE_FRAMES = 140
+STANCE_FRAMES = 45
+
+
+def _pair_loop(strikes, toeoffs):
+    """The previous per-strike pairing"""
+    pairs = list()
+    for strike in strikes:
+        toeoff_cands = toeoffs[np.where(toeoffs > strike)]
+        if len(toeoff_cands) == 0:
+            continue
+        pairs.append((strike, toeoff_cands[0]))
+    return tuple(np.array(x) for x in zip(*pairs))
+
+
+def _compressions_loop(dist, strikes, toeoffs):
+    """The previous per-strike compression"""
+    return np.array([dist[s] - dist[s:t].min() for s, t in zip(strikes, toeoffs)])
+
+
+@pytest.fixture(scope='module')
+def trial_data():
+    """Strikes, toeoffs and hip-ankle distance of a synthetic trial"""
+    rng = np.random.default_rng(0)
+    nframes = DURATION * FRAMERATE
+    strikes = np.arange(10, nframes - STRIDE_FRAMES, STRIDE_FRAMES)
+    strikes += rng.integers(-5, 5, len(strikes))
+    toeoffs = strikes + STANCE_FRAMES + rng.integers(-3, 3, len(strikes))
+    # the last strike has no toeoff
+    toeoffs = toeoffs[:-1]
+    # hip-ankle distance: dips during each stance phase, some gaps
+    t = np.arange(nframes)
+    dist = 900 - 40 * np.clip(np.sin(2 * np.pi * t / STRIDE_FRAMES), 0, None)
+    dist += rng.standard_normal(nframes)
+    dist[rng.integers(0, nframes, nframes // 100)] = np.nan
+    return strikes, toeoffs, dist
+
+
+@pytest.mark.benchmark(group='pairing')
+def test_pair_strikes(benchmark, trial_data):
+    strikes, toeoffs, _ = trial_data
+    pairs = benchmark(events.pair_strikes, strikes, toeoffs)
+    pairs_loop = _pair_loop(strikes, toeoffs)
+    assert len(pairs[0]) == len(strikes) - 1
+    for arr, arr_loop in zip(pairs, pairs_loop):
+        assert np.array_equal(arr, arr_loop)
+
+
+@pytest.mark.benchmark(group='pairing')
+def test_pair_strikes_loop(benchmark, trial_data):
+    strikes, toeoffs, _ = trial_data
+    benchmark(_pair_loop, strikes, toeoffs)
+
+
+@pytest.mark.benchmark(group='compression')
+def test_compressions(benchmark, trial_data):
+    strikes, toeoffs, dist = trial_data
+    pairs = _pair_loop(strikes, toeoffs)
+    comps = benchmark(running.compressions, dist, *pairs)
+    assert np.array_equal(comps, _compressions_loop(dist, *pairs), equal_nan=True)
+    # gaps within a stance phase propagate
+    assert np.isnan(comps).any()
+
+
+@pytest.mark.benchmark(group='compression')
+def test_compressions_loop(benchmark, trial_data):
+    strikes, toeoffs, dist = trial_data
+    pairs = _pair_loop(strikes, toeoffs)
+    benchmark(_compressions_loop, dist, *pairs)
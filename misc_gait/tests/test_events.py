@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the gait event index.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+
+import events
+
+
+def _cycle(context, start, end, toeoff, plate=None, index=None):
+    return SimpleNamespace(
+        context=context,
+        start=start,
+        end=end,
+        toeoff=toeoff,
+        on_forceplate=plate is not None,
+        plate_idx=plate,
+        index=index,
+    )
+
+
+def _stub_trial(**attrs):
+    """A stub of a gaitutils Trial.
+
+    As in Trial, the events and cycles are in frames with the offset already
+    removed; the offset itself must not be used again.
+    """
+    rstrikes, rtoeoffs = [40, 180, 320], [90, 230]
+    lstrikes, ltoeoffs = [110, 250, 390], [160, 300, 440]
+    cycles = [
+        _cycle('R', 40, 180, 90, plate=0, index=1),
+        _cycle('R', 180, 320, 230, index=2),
+        _cycle('L', 250, 390, 300, index=2),
+        _cycle('L', 110, 250, 160, plate=1, index=1),
+    ]
+    trial = SimpleNamespace(
+        offset=1000,
+        rstrikes=rstrikes,
+        lstrikes=lstrikes,
+        rtoeoffs=rtoeoffs,
+        ltoeoffs=ltoeoffs,
+        cycles=cycles,
+        framerate=200.0,
+        name='Subject',
+    )
+    trial.__dict__.update(attrs)
+    return trial
+
+
+def test_strikes_match_cycles():
+    index = events.EventIndex.from_trial(_stub_trial())
+    for context in 'LR':
+        starts = index.cycles[context]['start']
+        # each cycle starts at a strike, in the same frames
+        assert np.array_equal(index.strikes[context][: len(starts)], starts)
+        assert np.isin(starts, index.strikes[context]).all()
+        toeoffs = index.cycles[context]['toeoff']
+        assert np.isin(toeoffs, index.toeoffs[context]).all()
+
+
+def test_pairing_and_fp_cycles():
+    index = events.EventIndex.from_trial(_stub_trial())
+    strikes, toeoffs = index.paired('R')
+    # the last right strike has no toeoff
+    assert np.array_equal(strikes, [40, 180])
+    assert np.array_equal(toeoffs, [90, 230])
+    fp_cycles = index.fp_cycles('L')
+    assert np.array_equal(fp_cycles['start'], [110])
+    assert np.array_equal(fp_cycles['plate'], [1])
+
+
+def test_subject_name():
+    assert events.EventIndex.from_trial(_stub_trial()).subject_name == 'Subject'
+    tr = _stub_trial(subject_name='Other')
+    assert events.EventIndex.from_trial(tr).subject_name == 'Other'
+
+
+def test_save_load(tmp_path):
+    c3dfile = tmp_path / 'trial.c3d'
+    c3dfile.write_bytes(b'')
+    index = events.EventIndex.from_trial(_stub_trial())
+    events.save_index(index, str(c3dfile))
+    loaded = events.load_index(str(c3dfile))
+    assert loaded is not None
+    assert loaded.subject_name == index.subject_name
+    for context in 'LR':
+        assert np.array_equal(loaded.strikes[context], index.strikes[context])
+        for field in events.CYCLE_FIELDS:
+            assert np.array_equal(
+                loaded.cycles[context][field], index.cycles[context][field]
+            )
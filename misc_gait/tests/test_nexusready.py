@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the Nexus readiness probing, using FakeNexus.
+
+A fake clock replaces the time module of nexusready, so that the probe
+timing can be checked exactly and the tests do not sleep.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import functools
+from pathlib import Path
+
+import pytest
+
+import nexusready
+from nexusready import FakeNexus
+from sessionsched import SessionScheduler, Step
+
+
+class _FakeClock:
+    """Stands in for the time module; sleep() advances the clock"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = list()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _FakeClock()
+    monkeypatch.setattr(nexusready, 'time', clock)
+    monkeypatch.setattr(nexusready, 'restart_latencies', list())
+    return clock
+
+
+def test_backoff(clock):
+    fake = FakeNexus(startup_time=30.0)
+    latency = nexusready.wait_until_ready(fake, timeout=60.0)
+    delays = [0.5, 0.75, 1.125, 1.6875, 2.53125, 3.796875]
+    assert clock.sleeps[: len(delays)] == pytest.approx(delays)
+    # the interval is capped
+    assert max(clock.sleeps) == pytest.approx(nexusready.PROBE_MAX_DELAY)
+    # ready at the first probe after the startup time
+    assert latency == pytest.approx(sum(clock.sleeps))
+    assert 30.0 <= latency < 30.0 + clock.sleeps[-1]
+
+
+def test_ready_at_first_probe(clock):
+    fake = FakeNexus(startup_time=0.0)
+    latency = nexusready.wait_until_ready(fake)
+    assert latency == pytest.approx(nexusready.PROBE_INITIAL_DELAY)
+
+
+def test_timeout(clock):
+    fake = FakeNexus(startup_time=100.0)
+    with pytest.raises(RuntimeError, match='did not answer'):
+        nexusready.wait_until_ready(fake, timeout=20.0)
+    # the last wait is cut to the timeout
+    assert sum(clock.sleeps) == pytest.approx(20.0)
+
+
+def test_restart_latency(clock):
+    fake = FakeNexus(startup_time=2.0)
+    clock.now = 50.0  # Nexus has been running for a while
+    latency = nexusready.restart_nexus(fake)
+    assert nexusready.restart_latencies == [latency]
+    assert 2.0 <= latency < 3.0
+
+
+def test_restart_never_ready(clock):
+    fake = FakeNexus(startup_time=1.0)
+    fake._kill_nexus(restart=False)
+    assert not nexusready.nexus_is_ready(fake)
+    with pytest.raises(RuntimeError):
+        nexusready.wait_until_ready(fake, timeout=5.0)
+
+
+def test_run_postprocessing(monkeypatch):
+    pipelines = ['pipeline 1', 'pipeline 2']
+    monkeypatch.setattr(nexusready, '_postproc_pipelines', lambda: pipelines)
+    fake = FakeNexus(startup_time=0.0, pipeline_time=0.0)
+    runs = list()
+    monkeypatch.setattr(
+        fake, '_run_pipelines', lambda pls: runs.append((fake.trial, pls))
+    )
+    nexusready.run_postprocessing(['a.c3d', 'b.c3d'], api=fake)
+    assert runs == [('a.c3d', pipelines), ('b.c3d', pipelines)]
+
+
+def test_scheduled_postprocessing(monkeypatch):
+    """Postprocess sessions through the scheduler, in real time"""
+    pipelines = ['pipeline']
+    monkeypatch.setattr(nexusready, '_postproc_pipelines', lambda: pipelines)
+    monkeypatch.setattr(
+        nexusready,
+        '_postproc_c3dfiles',
+        lambda sessiondir: [str(sessiondir / f'trial{k}.c3d') for k in range(2)],
+    )
+    monkeypatch.setattr(nexusready, 'restart_latencies', list())
+    fake = FakeNexus(startup_time=0.05, pipeline_time=0.0)
+    runs = list()
+    run_pipelines = fake._run_pipelines
+
+    def _run_pipelines(pls):
+        run_pipelines(pls)
+        runs.append(fake.trial)
+
+    monkeypatch.setattr(fake, '_run_pipelines', _run_pipelines)
+
+    postprocess = functools.partial(nexusready.postprocess_session, api=fake)
+    sessions = [Path(f'session{k}') for k in range(3)]
+    sched = SessionScheduler()
+    sched.run(sessions, [Step('postproc pipelines', postprocess, nexus=True)])
+    # Nexus is restarted for each session; a restart during the pipelines of
+    # another session would make them fail
+    assert len(nexusready.restart_latencies) == len(sessions)
+    assert all(t >= fake.startup_time for t in nexusready.restart_latencies)
+    assert sorted(runs) == sorted(
+        str(p / f'trial{k}.c3d') for p in sessions for k in range(2)
+    )
+    assert len(sched.timings) == len(sessions)
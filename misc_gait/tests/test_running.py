@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the forceplate index of the running analysis.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+
+import running
+
+
+class _StubIndex:
+    """Stub of an EventIndex with forceplate cycles on the right side only"""
+
+    def __init__(self, starts, toeoffs, plates):
+        self._cycles = {
+            'R': {
+                'start': np.array(starts),
+                'toeoff': np.array(toeoffs),
+                'plate': np.array(plates),
+            },
+            'L': {
+                field: np.array([], dtype=int)
+                for field in ('start', 'toeoff', 'plate')
+            },
+        }
+
+    def fp_cycles(self, context):
+        return self._cycles[context]
+
+
+def _stub_trial(ftot, samplesperframe=2):
+    ftot = np.asarray(ftot, dtype=float)
+    forces = np.zeros(ftot.shape + (3,))
+    forces[..., 2] = ftot
+    fpdata = [{'F': f, 'Ftot': ft} for f, ft in zip(forces, ftot)]
+    return SimpleNamespace(forceplate_data=fpdata, samplesperframe=samplesperframe)
+
+
+def test_stance_max():
+    ftot = np.arange(40.0)
+    ftot[30] = 999.0  # after the stance phase
+    fpi = running.ForceplateIndex(
+        _stub_trial([ftot]), _StubIndex([2, 10], [6, -1], [0, 0])
+    )
+    # samples 4...11 are in the stance phase of the first cycle
+    assert fpi.stance_max('R', [2]) == [11.0]
+    # the second cycle has no toeoff, so the stance phase is unknown
+    assert ('R', 10) not in fpi.cycle_max
+    assert np.isnan(fpi.stance_max('R', [10])).all()
+    assert fpi.plate_max[0] == 999.0
+
+
+def test_force_at():
+    ftot = np.array([np.arange(20.0), 100 + np.arange(20.0)])
+    fpi = running.ForceplateIndex(_stub_trial(ftot), _StubIndex([], [], []))
+    forces = fpi.force_at(np.array([0, 1]), np.array([3, 5]))
+    assert np.array_equal(forces[:, 2], [6.0, 110.0])
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Per-session trial metadata index.
+
+Stores, for each trial of a session, the metadata needed for tagging: gait
+direction, number of valid forceplate contacts and the Eclipse notes and
+description. The index is kept in trial_metadata.json in the session
+directory. Entries are keyed by the state (mtime and size) of the c3d and
+Eclipse files, so a trial is loaded only when it is new or has changed.
+
+The metadata is produced by autoprocessing, which rewrites both files, so
+after autoproc every entry is out of date. Call refresh() once after autoproc
+to load the trials; later reads (tagging, reruns) then use the index. Writing
+the notes through set_notes() keeps the entries up to date.
+
+@author: Jussi (jnu@iki.fi)
+
+requires: gaitutils
+"""
+
+import os
+import os.path as op
+import json
+import logging
+
+import gaitutils
+from gaitutils import trial
+
+logger = logging.getLogger(__name__)
+
+INDEX_FNAME = 'trial_metadata.json'
+# increase when the stored entries change
+INDEX_VERSION = 1
+
+
+def _file_state(fname):
+    """Identify the state of a file"""
+    st = os.stat(fname)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def gait_direction(description):
+    """Quick and dirty gait direction from an Eclipse description.
+
+    XXX: fragile, relies on certain description string.
+    """
+    for dir in 'ET':
+        if dir in description:
+            return dir
+    return None
+
+
+def _count_fp_contacts(tr):
+    """Return n of valid forceplate contacts"""
+    return len(tr.fp_events['L_strikes']) + len(tr.fp_events['R_strikes'])
+
+
+def _read_eclipse(enffile):
+    """Read the Eclipse notes and description of a trial"""
+    keys = gaitutils.eclipse.get_eclipse_keys(enffile, return_empty=True)
+    return keys.get('NOTES', ''), keys.get('DESCRIPTION', '')
+
+
+class SessionMetadata:
+    """Trial metadata index of a session.
+
+    Parameters
+    ----------
+    sessiondir : str | Path
+        The session directory.
+    """
+
+    def __init__(self, sessiondir):
+        self.fname = op.join(sessiondir, INDEX_FNAME)
+        self._entries = dict()
+        try:
+            with open(self.fname, encoding='utf-8') as fh:
+                data = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get('version') == INDEX_VERSION:
+            self._entries = data['trials']
+
+    def _is_current(self, entry, c3dfile):
+        try:
+            return (
+                entry['c3d_state'] == _file_state(c3dfile)
+                and entry['enf_state'] == _file_state(entry['enffile'])
+            )
+        except FileNotFoundError:
+            return False
+
+    def get(self, c3dfile):
+        """Return the metadata of a trial.
+
+        The trial is loaded if it is not in the index or has changed. Returns a
+        dict with keys enffile, direction, fp_contacts, notes and description.
+        """
+        key = op.basename(c3dfile)
+        entry = self._entries.get(key)
+        if entry is None or not self._is_current(entry, c3dfile):
+            logger.debug('reading metadata for %s' % c3dfile)
+            tr = trial.Trial(c3dfile)
+            enffile = str(tr.enfpath)
+            notes, description = _read_eclipse(enffile)
+            entry = {
+                'enffile': enffile,
+                'direction': gait_direction(description),
+                'fp_contacts': _count_fp_contacts(tr),
+                'notes': notes,
+                'description': description,
+                'c3d_state': _file_state(c3dfile),
+                'enf_state': _file_state(enffile),
+            }
+            self._entries[key] = entry
+        return entry
+
+    def refresh(self, c3dfiles):
+        """Bring the entries of the given trials up to date, and save.
+
+        Trials that have not changed since they were indexed are not loaded.
+        """
+        for c3dfile in c3dfiles:
+            self.get(c3dfile)
+        self.save()
+
+    def set_notes(self, c3dfile, notes):
+        """Write the Eclipse notes of a trial, and update the index"""
+        entry = self.get(c3dfile)
+        gaitutils.eclipse.set_eclipse_keys(
+            entry['enffile'], {'NOTES': notes}, update_existing=True
+        )
+        entry['notes'] = notes
+        entry['enf_state'] = _file_state(entry['enffile'])
+
+    def save(self):
+        """Write the index into the session directory"""
+        with open(self.fname, 'w', encoding='utf-8') as fh:
+            json.dump({'version': INDEX_VERSION, 'trials': self._entries}, fh, indent=1)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Video conversion manager.
+
+Runs the gaitutils video converter for many files, with a cap on the number
+of converter processes running at once. Each process is waited for in a
+thread of the manager, which blocks until the process exits, so there is no
+sleep/poll loop. A single manager can be shared by several sessions, and
+convert() returns as soon as the files of its own session are done.
+
+A conversion is considered successful if the converted file exists and is
+not empty. The exit code of the converter is only logged, since
+ffmpeg2theora may crash after completing the conversion (gaitutils disables
+the crash dialogs for this reason).
+
+Example:
+
+    converter = ConversionManager()
+    converter.convert(vidfiles, name=sessiondir.name)
+
+@author: Jussi (jnu@iki.fi)
+
+requires: gaitutils
+"""
+
+import os
+import os.path as op
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from gaitutils import videos
+
+logger = logging.getLogger(__name__)
+
+# extension of the converted files, as in gaitutils.videos.convert_videos()
+CONV_EXT = '.ogv'
+
+
+def converted_fname(vidfile):
+    """Return the name of the converted file for a video file"""
+    return op.splitext(vidfile)[0] + CONV_EXT
+
+
+def _is_converted(vidfile):
+    """Whether the converted file exists and is not empty"""
+    try:
+        return os.path.getsize(converted_fname(vidfile)) > 0
+    except OSError:
+        return False
+
+
+class ConversionManager:
+    """Convert video files with a limited number of converter processes.
+
+    Parameters
+    ----------
+    max_procs : int, optional
+        Max number of converter processes running at once. Default is the
+        number of CPUs.
+    """
+
+    def __init__(self, max_procs=None):
+        self.max_procs = max_procs or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_procs, thread_name_prefix='videoconv'
+        )
+
+    def _convert_one(self, vidfile):
+        """Convert a file and wait for the converter; return its exit code"""
+        if not (procs := videos.convert_videos(vidfiles=[vidfile])):
+            raise RuntimeError(
+                f'video converter process could not be started for {vidfile}'
+            )
+        if (returncode := procs[0].wait()) != 0:
+            logger.warning(f'video converter exited with {returncode} for {vidfile}')
+        return returncode
+
+    def submit(self, vidfiles, name=''):
+        """Start converting files; return a future for each file.
+
+        Progress is printed, prefixed by name, as the files finish.
+        """
+        futures = [self._executor.submit(self._convert_one, f) for f in vidfiles]
+        n_total = len(futures)
+        n_complete = 0
+        lock = threading.Lock()
+
+        def _report_progress(future):
+            nonlocal n_complete
+            with lock:
+                n_complete += 1
+                print(f'{name}: converting videos: {n_complete} of {n_total} files done')
+
+        for future in futures:
+            future.add_done_callback(_report_progress)
+        return futures
+
+    def convert(self, vidfiles, name='', redo=False):
+        """Convert files and wait until they are done.
+
+        Files that are already converted are skipped, unless redo is True.
+        Returns the number of files converted. Raises RuntimeError if a
+        converter could not be started or did not produce a converted file.
+        """
+        if not redo:
+            vidfiles = [
+                f for f in vidfiles if not videos.convert_videos([f], check_only=True)
+            ]
+        futures = self.submit(vidfiles, name=name)
+        wait(futures)
+        failed = [
+            vidfile
+            for vidfile, future in zip(vidfiles, futures)
+            if future.exception() is not None or not _is_converted(vidfile)
+        ]
+        if failed:
+            raise RuntimeError(f'{name}: video conversion failed for {failed}')
+        return len(vidfiles)
+
+    def shutdown(self):
+        """Wait for running conversions and stop the manager"""
+        self._executor.shutdown(wait=True)